@@ -1,33 +1,64 @@
+import math
 import random
+import time
+import uuid
 from functools import partial
 
 import streamlit as st
 
+from backends import BACKENDS, OpenAIBackend, OpenAICompatibleBackend
+from cached_engine import (
+    generate_board,
+    get_backend,
+    get_game_db,
+    get_game_store,
+    get_hint_cache,
+    get_lang_options,
+    get_single_flight,
+    get_word_pool,
+    start_metrics_server,
+    start_preload,
+)
 from engine import (
+    DEFAULT_HISTORY_BUDGET,
+    DEFAULT_HISTORY_TURNS,
+    DEFAULT_SIDE_LENGTH,
     DEFAULT_SPYMASTER_INSTRUCT,
     FULL_LANGUAGES,
-    generate_board,
-    get_default_words_list,
-    get_lang_options,
-    get_openai_client,
+    Spymaster,
     init_spymaster,
 )
 from persistent_state import (
     BOARD_LANG_KEY,
+    BOARD_POOL_KEY,
+    BOARD_SIZE_KEY,
     BOARD_WORDS_KEY,
+    PERSISTENCE,
     SETTINGS_PAGE_NAME,
     SPYMASTER_BEHAVIOR_KEY,
+    SPYMASTER_CACHE_KEY,
+    SPYMASTER_CANDIDATES_KEY,
+    SPYMASTER_COALESCE_KEY,
+    SPYMASTER_HISTORY_BUDGET_KEY,
+    SPYMASTER_HISTORY_TURNS_KEY,
     SPYMASTER_INSTRUCT_KEY,
+    SPYMASTER_PREFETCH_KEY,
     SPYMASTER_PROMPT_KEY,
+    SPYMASTER_STREAM_KEY,
+    SPYMASTER_STRUCTURED_KEY,
     SPYMASTER_TEMP_KEY,
-    persist_key,
-    persist_session_state,
+    SPYMASTER_USAGE_KEY,
 )
 from styling import TEAM_TO_STYLE, set_game_style
+from telemetry import METRICS
 
 __PAGE_NAME__ = "Game"
+# Seconds between checks of a hint generated in the background
+HINT_POLL_INTERVAL = 0.3
+run_start = time.perf_counter()
 st.set_page_config(layout="wide")
 set_game_style()
+start_metrics_server()
 
 
 # Random seed
@@ -37,8 +68,11 @@ if f"{__PAGE_NAME__}_random_seed" not in st.session_state:
 
 
 # Initial setup - API parameters
-openai_api_key = persist_key(f"{__PAGE_NAME__}_api_key")
-openai_model_key = persist_key(f"{__PAGE_NAME__}_model_name")
+backend_key = PERSISTENCE.key(__PAGE_NAME__, "backend")
+openai_api_key = PERSISTENCE.key(__PAGE_NAME__, "api_key")
+api_base_url_key = PERSISTENCE.key(__PAGE_NAME__, "api_base_url")
+openai_model_key = PERSISTENCE.key(__PAGE_NAME__, "model_name")
+INIT_LANG_KEY = PERSISTENCE.key(__PAGE_NAME__, "init_lang")
 
 api_choice = f"{__PAGE_NAME__}_has_chosen_API"
 if api_choice not in st.session_state:
@@ -48,7 +82,36 @@ model_choice = f"{__PAGE_NAME__}_has_chosen_model"
 if model_choice not in st.session_state:
     st.session_state[model_choice] = False
 
+# Settings stored with every game, API keys excepted
+RESUMED_KEYS = [backend_key, api_base_url_key, openai_model_key, BOARD_LANG_KEY]
+
+# Resume the game in the URL after a reconnection or a server restart, skipping
+# the setup if its backend needs no API key. Its settings are only restored once
+# per session, so that they can still be changed on the setup screen.
+resumed_key = f"{__PAGE_NAME__}_resumed_game"
+if (
+    not st.session_state[api_choice]
+    and "game" in st.query_params
+    and st.session_state.get(resumed_key) != st.query_params["game"]
+):
+    st.session_state[resumed_key] = st.query_params["game"]
+    saved = get_game_db().load(st.query_params["game"])
+    if saved is not None:
+        for key, value in saved.settings.items():
+            PERSISTENCE.set(key, value)
+        if saved.settings.get(backend_key) not in (
+            OpenAIBackend.name,
+            OpenAICompatibleBackend.name,
+        ):
+            st.session_state[api_choice] = st.session_state[model_choice] = True
+
+PERSISTENCE.restore(__PAGE_NAME__)
+
 if not (st.session_state[api_choice] and st.session_state[model_choice]):
+    # Cold start: load the words lists and the API client while the player is
+    # choosing
+    start_preload()
+
     # Some info
     st.header("Codenames Solo")
     col1, _, col2, _ = st.columns((0.17, 0.05, 0.73, 0.05))
@@ -69,14 +132,29 @@ if not (st.session_state[api_choice] and st.session_state[model_choice]):
             unsafe_allow_html=True,
         )
 
-    # OpenAI API key
-    st.subheader("OpenAI API")
-    openai_api = st.text_input(
-        label="Enter a valid OpenAI API key",
-        value="",
-        key=openai_api_key,
+    # Backend and OpenAI API key
+    st.subheader("Spymaster API")
+    backend_name = st.selectbox(
+        label="Select how hints are generated",
+        options=list(BACKENDS),
+        format_func=BACKENDS.get,
+        key=backend_key,
         disabled=st.session_state[api_choice],
     )
+    if backend_name == OpenAICompatibleBackend.name:
+        st.text_input(
+            label="Enter the base URL of the endpoint",
+            value="http://localhost:8000/v1",
+            key=api_base_url_key,
+            disabled=st.session_state[api_choice],
+        )
+    if backend_name in (OpenAIBackend.name, OpenAICompatibleBackend.name):
+        st.text_input(
+            label="Enter a valid OpenAI API key",
+            value="",
+            key=openai_api_key,
+            disabled=st.session_state[api_choice],
+        )
 
     def _on_click_() -> None:
         st.session_state[api_choice] = True
@@ -84,10 +162,14 @@ if not (st.session_state[api_choice] and st.session_state[model_choice]):
     st.button("Next", on_click=_on_click_)
 
     if st.session_state[api_choice]:
-        openai_client, available_models = get_openai_client(openai_api)
+        backend, available_models = get_backend(
+            backend_name,
+            api_key=PERSISTENCE.get(openai_api_key, ""),
+            base_url=PERSISTENCE.get(api_base_url_key, ""),
+        )
         try:
-            if openai_model_key in st.session_state:
-                index = available_models.index(st.session_state[openai_model_key])
+            if openai_model_key in PERSISTENCE:
+                index = available_models.index(PERSISTENCE.get(openai_model_key))
             else:
                 index = available_models.index("gpt-3.5-turbo-0125")
         except ValueError:
@@ -97,7 +179,7 @@ if not (st.session_state[api_choice] and st.session_state[model_choice]):
         # Model choice
         with col1:
             st.selectbox(
-                label="Select an OpenAI model",
+                label="Select a model",
                 options=available_models,
                 index=index,
                 key=openai_model_key,
@@ -106,9 +188,26 @@ if not (st.session_state[api_choice] and st.session_state[model_choice]):
             def _on_click_() -> None:
                 st.session_state[model_choice] = True
 
+            # Models may be listed in the background, which also checks the API
+            # key: the page reruns with them once listed
+            @st.fragment(run_every=HINT_POLL_INTERVAL)
+            def __wait_for_models__() -> None:
+                if not backend.models_status()[0]:
+                    st.rerun()
+                st.caption("Listing the models available with this API key ...")
+
+            def _on_back_() -> None:
+                st.session_state[api_choice] = False
+
+            listing_models, models_error = backend.models_status()
+            if listing_models:
+                __wait_for_models__()
+            elif models_error is not None:
+                st.error(f"Could not list the models: {models_error}")
+                st.button("Change API settings", on_click=_on_back_)
+
         # Language choice
         with col2:
-            INIT_LANG_KEY = persist_key(f"{__PAGE_NAME__}_init_lang")
             options = get_lang_options()
             try:
                 default_index = options.index("en")
@@ -117,160 +216,267 @@ if not (st.session_state[api_choice] and st.session_state[model_choice]):
 
             def __update_lang__() -> None:
                 global DEFAULT_SPYMASTER_INSTRUCT
-                if BOARD_WORDS_KEY in st.session_state:
-                    del st.session_state[BOARD_WORDS_KEY]
-                st.session_state[BOARD_LANG_KEY] = st.session_state[INIT_LANG_KEY]
-                lang = FULL_LANGUAGES[st.session_state[BOARD_LANG_KEY]]
-                st.session_state[SPYMASTER_INSTRUCT_KEY] = (
+                PERSISTENCE.pop(BOARD_WORDS_KEY)
+                st.session_state.pop(BOARD_POOL_KEY, None)
+                PERSISTENCE.set(BOARD_LANG_KEY, PERSISTENCE.get(INIT_LANG_KEY))
+                lang = FULL_LANGUAGES[PERSISTENCE.get(BOARD_LANG_KEY)]
+                PERSISTENCE.set(
+                    SPYMASTER_INSTRUCT_KEY,
                     f"{DEFAULT_SPYMASTER_INSTRUCT}. You are playing the game in {lang}"
-                    f" and your answers should be in {lang}"
+                    f" and your answers should be in {lang}",
                 )
 
             lang = st.selectbox(
                 label="Select Language",
                 options=options,
-                index=options.index(st.session_state[INIT_LANG_KEY])
-                if INIT_LANG_KEY in st.session_state
+                index=options.index(PERSISTENCE.get(INIT_LANG_KEY))
+                if INIT_LANG_KEY in PERSISTENCE
                 else default_index,
-                key=f"{__PAGE_NAME__}_init_lang",
+                key=INIT_LANG_KEY,
                 on_change=__update_lang__,
             )
 
-        st.button("Start", on_click=_on_click_)
+        # Words list edited in Settings, if any
+        pool = st.session_state.get(BOARD_POOL_KEY)
+        supported = backend.supports_lang(lang, None if pool is None else pool.words)
+        if not supported:
+            st.error(
+                "This backend cannot give hints for the words list in "
+                f"{FULL_LANGUAGES.get(lang, lang)}"
+            )
+        st.button(
+            "Start",
+            on_click=_on_click_,
+            disabled=models_error is not None or not supported,
+        )
 
 # Play the game
 else:
-    # Init game state and spymaster
-    side_length = 5
-    if BOARD_WORDS_KEY not in st.session_state:
-        st.session_state[BOARD_WORDS_KEY] = get_default_words_list(
-            st.session_state.get(BOARD_LANG_KEY, "en")
+    # Every game is stored under its own id, also kept in the URL so that the
+    # game resumes after a reconnection or a server restart
+    game_id_key = f"{__PAGE_NAME__}_game_id"
+    if game_id_key not in st.session_state:
+        st.session_state[game_id_key] = st.query_params.get("game", uuid.uuid4().hex)
+    game_id = st.session_state[game_id_key]
+    if st.query_params.get("game") != game_id:
+        st.query_params["game"] = game_id
+
+    backend, available_models = get_backend(
+        PERSISTENCE.get(backend_key),
+        api_key=PERSISTENCE.get(openai_api_key, ""),
+        base_url=PERSISTENCE.get(api_base_url_key, ""),
+    )
+    game_db = get_game_db()
+
+    def __load_game__() -> Spymaster:
+        saved = game_db.load(game_id)
+        if saved is not None:
+            words, team_assignment = saved.words, saved.team_assignment
+        else:
+            # New game, the board size is fixed until restart
+            side_length = PERSISTENCE.get(BOARD_SIZE_KEY, DEFAULT_SIDE_LENGTH)
+            pool = st.session_state.get(BOARD_POOL_KEY)
+            if pool is None:
+                pool = get_word_pool(PERSISTENCE.get(BOARD_LANG_KEY, "en"))
+            if len(pool) < side_length**2:
+                st.error(
+                    f"The words list needs at least {side_length**2} distinct words "
+                    f"for a {side_length}x{side_length} board, edit it on the "
+                    "Settings page"
+                )
+                st.stop()
+            with METRICS.timer("phase_seconds", phase="generate_board"):
+                words, team_assignment = generate_board(
+                    pool=pool,
+                    side_length=side_length,
+                    random_seed=st.session_state[f"{__PAGE_NAME__}_random_seed"],
+                )
+        try:
+            spymaster = init_spymaster(
+                backend,
+                PERSISTENCE.get(openai_model_key),
+                words,
+                team_assignment,
+                PERSISTENCE.get(BOARD_LANG_KEY, "en"),
+            )
+        except ValueError as e:
+            st.error(f"The spymaster cannot play this board: {e}")
+            st.stop()
+        if saved is not None:
+            if SPYMASTER_PROMPT_KEY in PERSISTENCE:
+                spymaster.update_prompt(PERSISTENCE.get(SPYMASTER_PROMPT_KEY))
+            spymaster.replay(saved.moves)
+        else:
+            game_db.create(
+                game_id,
+                words,
+                team_assignment,
+                {k: PERSISTENCE.get(k) for k in RESUMED_KEYS if k in PERSISTENCE},
+            )
+        spymaster.use_game_db(game_db, game_id)
+        return spymaster
+
+    game_store = get_game_store()
+    with METRICS.timer("phase_seconds", phase="load_game"):
+        spymaster = game_store.get_or_create(game_id, __load_game__)
+    words, team_assignment = spymaster.board.words, spymaster.board.cards
+    side_length = math.isqrt(len(words))
+    if SPYMASTER_PROMPT_KEY in PERSISTENCE:
+        spymaster.update_prompt(PERSISTENCE.get(SPYMASTER_PROMPT_KEY))
+
+    if SPYMASTER_INSTRUCT_KEY in PERSISTENCE:
+        spymaster.update_instruct(PERSISTENCE.get(SPYMASTER_INSTRUCT_KEY))
+
+    if SPYMASTER_BEHAVIOR_KEY in PERSISTENCE:
+        spymaster.use_history(
+            PERSISTENCE.get(SPYMASTER_BEHAVIOR_KEY),
+            budget=PERSISTENCE.get(
+                SPYMASTER_HISTORY_BUDGET_KEY, DEFAULT_HISTORY_BUDGET
+            ),
+            num_turns=PERSISTENCE.get(
+                SPYMASTER_HISTORY_TURNS_KEY, DEFAULT_HISTORY_TURNS
+            ),
         )
 
-    words, team_assignment = generate_board(
-        words_list=st.session_state[BOARD_WORDS_KEY],
-        side_length=side_length,
-        random_seed=st.session_state[f"{__PAGE_NAME__}_random_seed"],
-    )
-    openai_client, available_models = get_openai_client(
-        st.session_state[openai_api_key]
+    if SPYMASTER_TEMP_KEY in PERSISTENCE:
+        spymaster.update_temperature(PERSISTENCE.get(SPYMASTER_TEMP_KEY))
+
+    spymaster.use_hint_cache(
+        get_hint_cache() if PERSISTENCE.get(SPYMASTER_CACHE_KEY, True) else None
     )
-    spymaster = init_spymaster(
-        openai_client, st.session_state[openai_model_key], words, team_assignment
+
+    spymaster.use_single_flight(
+        get_single_flight() if PERSISTENCE.get(SPYMASTER_COALESCE_KEY, True) else None
     )
-    if SPYMASTER_PROMPT_KEY in st.session_state:
-        spymaster.update_prompt(st.session_state[SPYMASTER_PROMPT_KEY])
 
-    if SPYMASTER_INSTRUCT_KEY in st.session_state:
-        spymaster.update_instruct(st.session_state[SPYMASTER_INSTRUCT_KEY])
+    spymaster.use_streaming(PERSISTENCE.get(SPYMASTER_STREAM_KEY, True))
 
-    if SPYMASTER_BEHAVIOR_KEY in st.session_state:
-        spymaster.use_whole_history(st.session_state[SPYMASTER_BEHAVIOR_KEY])
+    spymaster.use_candidates(PERSISTENCE.get(SPYMASTER_CANDIDATES_KEY, 1))
 
-    if SPYMASTER_TEMP_KEY in st.session_state:
-        spymaster.update_temperature(st.session_state[SPYMASTER_TEMP_KEY])
+    spymaster.use_structured_output(PERSISTENCE.get(SPYMASTER_STRUCTURED_KEY, False))
 
-    # Generate board
-    columns = st.columns(side_length)
-    for i, c in enumerate(columns):
-        for j in range(side_length):
-            idx = i * side_length + j
-            key = persist_key(f"{__PAGE_NAME__}_word_{idx:02d}")
+    # Start generating the next hints while the board renders
+    spymaster.use_prefetch(PERSISTENCE.get(SPYMASTER_PREFETCH_KEY, False))
+    spymaster.prefetch()
 
-            def __on_click__(button_key: str, word: str, team: int) -> None:
-                spymaster.remove(word, team)
-                st.session_state[button_key] = True
+    # Shown in place of the hint while it is generated, until the page reruns
+    # with it
+    @st.fragment(run_every=HINT_POLL_INTERVAL)
+    def __thinking__(team: int) -> None:
+        if spymaster.hint_ready():
+            st.rerun()
+        fmt = ":blue[{}]" if team == 1 else ":red[{}]"
+        text = spymaster.partial_hints.get(team, "").strip()
+        st.markdown(fmt.format(f"{text} ..." if text else "Spymaster thinking ..."))
+
+    # The play area reruns on its own when a card or button is clicked, without
+    # rebuilding the page and the spymaster above
+    @st.fragment
+    def __play_area__() -> None:
+        # The hint is generated in the background, so that the board is shown,
+        # and Pass and Restart can be clicked, while waiting for it. A hint which
+        # failed is only generated again on demand, never blocking the page.
+        spymaster.start_hint()
+        thinking = not spymaster.hint_ready()
+        failed = not thinking and spymaster.hint_failed()
+        hint, game_end = (
+            ("", 0) if thinking or failed else spymaster.play(fallback=False)
+        )
+        st.session_state[SPYMASTER_USAGE_KEY] = dict(
+            spymaster.token_usage, requests=spymaster.num_requests
+        )
 
-            # already pressed
-            if st.session_state.get(key, False):
-                columns[i].markdown(
-                    f'<span class="card {TEAM_TO_STYLE[team_assignment[idx]]}"></span>',
+        # Generate board
+        columns = st.columns(side_length)
+        for i, c in enumerate(columns):
+            for j in range(side_length):
+                idx = i * side_length + j
+                # already guessed: styled by the color in its key
+                if words[idx] not in spymaster.board:
+                    columns[i].button(
+                        words[idx],
+                        disabled=True,
+                        key=f"card_{TEAM_TO_STYLE[team_assignment[idx]]}_{idx:02d}",
+                    )
+                # not guessed
+                else:
+                    columns[i].button(
+                        words[idx],
+                        key=f"card_hidden_{idx:02d}",
+                        disabled=thinking or failed,
+                        on_click=partial(
+                            spymaster.remove,
+                            word=words[idx],
+                            team=team_assignment[idx],
+                        ),
+                    )
+
+        columns = st.columns((0.3, 0.1, 0.2, 0.1, 0.3))
+
+        # Celebrate upon win !
+        if game_end == 1:
+            st.balloons()
+
+        # Show history of each team
+        for col_idx, team in [(0, 0), (-1, 1)]:
+            with columns[col_idx]:
+                if spymaster.current_team != team:
+                    st.markdown("""&zwnj;    \n&zwnj;""")
+                elif thinking:
+                    __thinking__(team)
+                elif failed:
+                    st.error("The spymaster could not give a hint")
+                    st.button("Retry", on_click=spymaster.retry_hint)
+                else:
+                    st.markdown(hint)
+                with st.expander("Show History"):
+                    st.markdown(spymaster.get_history(team))
+
+        for col_idx, team in [(1, 0), (-2, 1)]:
+            with columns[col_idx]:
+                st.markdown(
+                    f'<span class="{TEAM_TO_STYLE[team + 1]}"></span>',
                     unsafe_allow_html=True,
                 )
-                columns[i].button(words[idx], disabled=True)
-            # not pressed
-            else:
-                columns[i].markdown(
-                    f'<span class="card"></span>', unsafe_allow_html=True
-                )
-                columns[i].button(
-                    words[idx],
-                    on_click=partial(
-                        __on_click__,
-                        button_key=key,
-                        word=words[idx],
-                        team=team_assignment[idx],
-                    ),
+                st.button(
+                    f"{spymaster.board.count(team + 1)}",
+                    disabled=True,
+                    key=f"counter_{team}",
                 )
 
-    # generate prompt
-    hint, game_end = spymaster.play()
-
-    # Celebrate upon win !
-    if game_end == 1:
-        st.balloons()
-
-    # Show history of each team
-    columns = st.columns((0.3, 0.1, 0.2, 0.1, 0.3))
-    for col_idx, team in [(0, 0), (-1, 1)]:
-        with columns[col_idx]:
+        # Interaction
+        with columns[2]:
+            # Skip your turn
             st.markdown(
-                hint if spymaster.current_team == team else """&zwnj;    \n&zwnj;"""
-            )
-            with st.expander("Show History"):
-                st.markdown(spymaster.get_history(team))
-
-    for col_idx, team in [(1, 0), (-2, 1)]:
-        with columns[col_idx]:
-            st.markdown(
-                f'<span class="{TEAM_TO_STYLE[team + 1]}"></span>',
+                f'<span class="beige"></span>',
                 unsafe_allow_html=True,
             )
             st.button(
-                f"{len(spymaster.words(team))}", disabled=True, key=f"counter_{team}"
+                "Pass your turn",
+                on_click=spymaster.pass_turn,
+                disabled=game_end,
             )
 
-    # Interaction
-    with columns[2]:
-        # Skip your turn
-        st.markdown(
-            f'<span class="beige"></span>',
-            unsafe_allow_html=True,
-        )
-        st.button(
-            "Pass your turn",
-            on_click=lambda spymaster=spymaster: spymaster.end_turn(),
-            disabled=game_end,
-        )
+            # Restart game at any moment
+            if st.button("Restart"):
+                game_store.discard(game_id)
+                game_db.delete(game_id)
+                del st.query_params["game"]
+                keys = list(st.session_state.keys())
+                for key in keys:
+                    if not (
+                        key in [api_choice, model_choice, PERSISTENCE.VALUES_KEY]
+                        or key.startswith(SETTINGS_PAGE_NAME)
+                    ):
+                        st.session_state.pop(key)
+                st.session_state[f"{__PAGE_NAME__}_random_seed"] = random.randint(
+                    0, 1000
+                )
+                st.rerun()
+
+    __play_area__()
 
-        # Restart game at any moment
-        if st.button("Restart"):
-            keys = list(st.session_state.keys())
-            for key in keys:
-                if not (
-                    key
-                    in [
-                        api_choice,
-                        model_choice,
-                        openai_model_key,
-                        openai_api_key,
-                    ]
-                    or key.startswith(SETTINGS_PAGE_NAME)
-                ):
-                    st.session_state.pop(key)
-                else:
-                    st.session_state[key] = st.session_state[key]
-            st.cache_resource.clear()
-            st.cache_data.clear()
-            st.session_state[f"{__PAGE_NAME__}_random_seed"] = random.randint(0, 1000)
-            persist_session_state(__PAGE_NAME__)
-            st.rerun()
 
-# Alwyays carry session state across pages
-# We need to carry the value of the widgets that were not visible
-# In this case, this means the widgets from other pages + the OpenAI API
-# settings as they are only displayed once
-persist_session_state(__PAGE_NAME__)
-if st.session_state[api_choice] and st.session_state[model_choice]:
-    st.session_state[openai_api_key] = st.session_state[openai_api_key]
-    st.session_state[openai_model_key] = st.session_state[openai_model_key]
+# Always carry the widget values across pages
+PERSISTENCE.save(__PAGE_NAME__)
+METRICS.observe("page_seconds", time.perf_counter() - run_start, page=__PAGE_NAME__)
@@ -0,0 +1,262 @@
+"""Clients of OpenAI-compatible APIs shared by all sessions
+
+There is one client per API key and endpoint, with a pool of HTTP connections,
+a token bucket limiting the rate of requests, a bound on the number of requests
+in flight, retries with jittered exponential backoff on rate limits and server
+errors, and a cached list of models refreshed in the background.
+"""
+
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterator, List, Optional, TypeVar
+
+from backends import BackendError
+from telemetry import METRICS
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity`
+    available at once"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Take `tokens`, waiting until they are available, and return the time
+        waited in seconds"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def backoff_delay(
+    attempt: int, base: float, max_delay: float, rng: random.Random = random
+) -> float:
+    """Exponential backoff with full jitter: uniform between 0 and
+    `base * 2**attempt`, capped at `max_delay`, so that clients rate limited
+    at the same time do not retry at the same time"""
+    return rng.uniform(0, min(max_delay, base * 2**attempt))
+
+
+class APIClient:
+    """Client of an OpenAI-compatible API, safe to share between threads
+
+    :param api_key: API key
+    :param base_url: Endpoint, None for the OpenAI API
+    :param requests_per_second: Sustained rate of requests
+    :param burst: Number of requests which can be sent at once after a pause
+    :param max_concurrency: Maximum number of requests in flight, streams
+        included
+    :param max_retries: Retries on rate limits, server and connection errors
+    :param backoff_base: Maximum delay before the first retry, in seconds, which
+        doubles with every retry
+    :param max_backoff: Maximum delay before a retry, in seconds
+    :param models_ttl: The list of models is refreshed after `models_ttl` seconds
+    :param models_retry: A failed fetch of the list of models is not retried for
+        `models_retry` seconds
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        requests_per_second: float = 10.0,
+        burst: float = 20.0,
+        max_concurrency: int = 16,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        max_backoff: float = 20.0,
+        models_ttl: float = 3600.0,
+        models_retry: float = 30.0,
+    ) -> None:
+        from openai import OpenAI
+
+        # A single client, hence a single pool of HTTP connections, serves all
+        # requests. Retries are handled here, with the rate limiter.
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.models_ttl = models_ttl
+        self.models_retry = models_retry
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._models: Optional[List[str]] = None
+        # Never fetched: stale whatever the uptime of the host
+        self._models_fetched = self._models_failed = float("-inf")
+        self._refreshing = False
+        self.models_error: Optional[BackendError] = None
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0.0}
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        """Delay before retrying a failed request: the one asked by the server
+        if any, otherwise a jittered backoff"""
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                return min(self.max_backoff, float(response.headers["retry-after"]))
+            except (KeyError, ValueError):
+                pass
+        return backoff_delay(attempt, self.backoff_base, self.max_backoff)
+
+    def _send(self, send: Callable[[], T], hold_slot: bool) -> T:
+        """Send a request within the rate and concurrency limits, retrying on
+        transient errors. If `hold_slot`, the concurrency slot is still held
+        when this returns."""
+        import openai
+
+        for attempt in range(self.max_retries + 1):
+            waited = self.bucket.acquire()
+            self.stats["throttled"] += waited
+            if waited:
+                METRICS.inc("api_throttled_seconds_total", waited)
+            self._slots.acquire()
+            self.stats["requests"] += 1
+            try:
+                result = send()
+            except (
+                openai.RateLimitError,
+                openai.InternalServerError,
+                openai.APIConnectionError,
+            ) as e:
+                self._slots.release()
+                error = e
+            except openai.APIStatusError as e:
+                self._slots.release()
+                METRICS.inc("api_errors_total", error=type(e).__name__)
+                raise BackendError(str(e)) from e
+            except BaseException:
+                self._slots.release()
+                raise
+            else:
+                if not hold_slot:
+                    self._slots.release()
+                return result
+            METRICS.inc("api_errors_total", error=type(error).__name__)
+            if attempt < self.max_retries:
+                self.stats["retries"] += 1
+                METRICS.inc("api_retries_total")
+                time.sleep(self.retry_delay(attempt, error))
+        raise BackendError(str(error)) from error
+
+    def request(self, send: Callable[[], T]) -> T:
+        """Send a request, e.g. `lambda: client.chat.completions.create(...)`
+
+        :raises BackendError: if it still fails after all retries, or on errors
+            which are not worth retrying (invalid request, authentication)
+        """
+        return self._send(send, hold_slot=False)
+
+    def stream(self, send: Callable[[], Any]) -> Iterator[Any]:
+        """Send a streamed request and yield its chunks; the request counts as
+        in flight until the stream is exhausted or closed
+
+        :raises BackendError: as `request`, and on errors while streaming
+        """
+        import openai
+
+        stream = self._send(send, hold_slot=True)
+        try:
+            yield from stream
+        except (openai.APIConnectionError, openai.APIStatusError) as e:
+            raise BackendError(str(e)) from e
+        finally:
+            # Closes the HTTP response, hence stops generation server-side
+            stream.close()
+            self._slots.release()
+
+    def list_models(self, default: Optional[List[str]] = None) -> List[str]:
+        """Models available with this client
+
+        The list is cached, and once older than `models_ttl` it is refreshed in
+        the background while the cached list is still returned. Only the first
+        call waits for the API, unless a `default` list is given: it is then
+        returned at once while the list is fetched in the background.
+
+        :raises BackendError: if the first fetch fails; it is then not retried
+            for `models_retry` seconds, an empty list being returned meanwhile
+            and the error kept in `models_error`
+        """
+        with self._lock:
+            models = self._models
+            now = time.monotonic()
+            failed = now - self._models_failed <= self.models_retry
+            stale = now - self._models_fetched > self.models_ttl and not failed
+            refresh = (models is not None or default is not None) and stale
+            refresh = refresh and not self._refreshing
+            self._refreshing |= refresh
+        if models is None and default is None:
+            return [] if failed else self._fetch_models()
+        if refresh:
+            threading.Thread(
+                target=self._fetch_models, kwargs={"background": True}, daemon=True
+            ).start()
+        return models if models is not None else list(default)
+
+    @property
+    def fetching_models(self) -> bool:
+        """Whether the list of models is being fetched in the background"""
+        return self._refreshing
+
+    def _fetch_models(self, background: bool = False) -> List[str]:
+        """Fetch the list of models; when in the background, a failure is kept
+        in `models_error` instead of being raised"""
+        try:
+            models = self.request(lambda: [x.id for x in self.client.models.list()])
+        except BackendError as e:
+            with self._lock:
+                self.models_error = e
+                self._models_failed = time.monotonic()
+                self._refreshing = False
+            if not background:
+                raise
+            return self._models
+        with self._lock:
+            self._models = models
+            self._models_fetched = time.monotonic()
+            self.models_error = None
+            self._refreshing = False
+        return models
+
+
+# Maximum number of clients kept, least recently used ones being dropped so that
+# the API keys entered in past sessions do not stay in memory
+MAX_CLIENTS = 64
+
+# Clients by hash of their API key and endpoint, least recently used first
+_CLIENTS: "OrderedDict[str, APIClient]" = OrderedDict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(api_key: str, base_url: Optional[str] = None) -> APIClient:
+    """Return the client shared by all users of this API key and endpoint"""
+    key = hashlib.sha256(f"{base_url}\n{api_key}".encode()).hexdigest()
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.pop(key, None)
+        if client is None:
+            client = APIClient(api_key, base_url)
+        _CLIENTS[key] = client
+        while len(_CLIENTS) > MAX_CLIENTS:
+            _CLIENTS.popitem(last=False)
+        return client
@@ -0,0 +1,492 @@
+"""Backends queried by the spymaster to generate hints"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from engine import Spymaster
+
+
+class BackendError(Exception):
+    """Transient error when querying a backend (rate limit, server error, timeout).
+    The spymaster retries on these."""
+
+
+@dataclass
+class Completion:
+    """Text generated by a backend and its token usage
+
+    When several completions were sampled for the same request, `choices` holds
+    all of them, `content` being the first one.
+    """
+
+    content: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Prompt tokens served from the provider's prefix cache
+    cached_tokens: int = 0
+    choices: List[str] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        if not len(self.choices):
+            self.choices = [self.content]
+
+
+class SpymasterBackend:
+    """Base interface of a backend generating chat completions"""
+
+    name = "base"
+
+    def list_models(self) -> List[str]:
+        """Return the names of the models available with this backend"""
+        raise NotImplementedError
+
+    def models_status(self) -> Tuple[bool, Optional[str]]:
+        """Whether the models are still being listed in the background, and the
+        error of the last attempt at listing them if it failed, e.g. because of
+        an invalid API key"""
+        return False, None
+
+    def supports_lang(self, lang: str, words: Optional[List[str]] = None) -> bool:
+        """Whether this backend can give hints for a board in language `lang`,
+        drawn from `words` if given rather than from the default words list"""
+        return True
+
+    def init_spymaster(
+        self,
+        model_name: str,
+        words: List[str],
+        team_assignment: List[int],
+        lang: str = "en",
+    ) -> "Spymaster":
+        """Build the spymaster of a board in language `lang`, querying this backend"""
+        from engine import Spymaster
+
+        spymaster = Spymaster(self, model_name)
+        spymaster.update_words(words, team_assignment)
+        return spymaster
+
+    def complete(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        n: int = 1,
+        response_format: Optional[Dict] = None,
+    ) -> Completion:
+        """Generate a completion for the given chat `messages`
+
+        :param n: Number of completions to sample in this single request
+        :param response_format: Constraint on the answers, e.g. a JSON schema, in
+            the format of the OpenAI API
+        :raises BackendError: on transient errors worth retrying
+        """
+        raise NotImplementedError
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        response_format: Optional[Dict] = None,
+    ) -> Iterator[Union[str, Completion]]:
+        """Generate a completion as a stream of text chunks. Closing the generator
+        early (`.close()`) aborts the generation. Once the text is complete, the
+        token usage is yielded as a `Completion` without content, if known.
+
+        :raises BackendError: on transient errors worth retrying
+        """
+        completion = self.complete(
+            model, messages, temperature, response_format=response_format
+        )
+        yield completion.content
+        yield Completion(
+            content="",
+            prompt_tokens=completion.prompt_tokens,
+            completion_tokens=completion.completion_tokens,
+            cached_tokens=completion.cached_tokens,
+        )
+
+
+class OpenAIBackend(SpymasterBackend):
+    """Backend using the OpenAI chat completions API"""
+
+    name = "openai"
+    # Shown until the models of the account are fetched, None to wait for them
+    default_models: Optional[List[str]] = [
+        "gpt-4o-mini",
+        "gpt-4o",
+        "gpt-4.1-mini",
+        "gpt-4.1",
+        "gpt-3.5-turbo-0125",
+    ]
+
+    def __init__(self, api_key: str, base_url: Optional[str] = None) -> None:
+        from api_client import get_client
+
+        # Connections, rate limits and the models list are shared by all the
+        # backends using the same API key and endpoint
+        self.api = get_client(api_key, base_url)
+        self.client = self.api.client
+
+    def list_models(self) -> List[str]:
+        return self.api.list_models(default=self.default_models)
+
+    def models_status(self) -> Tuple[bool, Optional[str]]:
+        error = self.api.models_error
+        return self.api.fetching_models, None if error is None else str(error)
+
+    def complete(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        n: int = 1,
+        response_format: Optional[Dict] = None,
+    ) -> Completion:
+        # Only send optional parameters when needed, some compatible endpoints
+        # reject them
+        kwargs = {"n": n} if n > 1 else {}
+        if response_format is not None:
+            kwargs["response_format"] = response_format
+        completion = self.api.request(
+            lambda: self.client.chat.completions.create(
+                model=model, messages=messages, temperature=temperature, **kwargs
+            )
+        )
+        usage = completion.usage
+        details = getattr(usage, "prompt_tokens_details", None)
+        choices = [x.message.content or "" for x in completion.choices]
+        return Completion(
+            content=choices[0],
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            cached_tokens=getattr(details, "cached_tokens", None) or 0,
+            choices=choices,
+        )
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        response_format: Optional[Dict] = None,
+    ) -> Iterator[Union[str, Completion]]:
+        kwargs = {} if response_format is None else {"response_format": response_format}
+        stream = self.api.stream(
+            lambda: self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                # The usage comes in a last chunk, without choices
+                stream_options={"include_usage": True},
+                **kwargs,
+            )
+        )
+        try:
+            for chunk in stream:
+                if len(chunk.choices) and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    details = getattr(usage, "prompt_tokens_details", None)
+                    yield Completion(
+                        content="",
+                        prompt_tokens=usage.prompt_tokens,
+                        completion_tokens=usage.completion_tokens,
+                        cached_tokens=getattr(details, "cached_tokens", None) or 0,
+                    )
+        finally:
+            stream.close()
+
+
+class OpenAICompatibleBackend(OpenAIBackend):
+    """Backend for any local or remote HTTP endpoint implementing the OpenAI API,
+    e.g. `mock_server.py`, vLLM or llama.cpp servers"""
+
+    name = "compatible"
+    # Models of other endpoints cannot be guessed
+    default_models = None
+
+    def __init__(self, base_url: str, api_key: str = "") -> None:
+        super().__init__(api_key=api_key or "none", base_url=base_url)
+
+
+class MockBackend(SpymasterBackend):
+    """Deterministic stand-in for a language model, answering without network
+
+    Answers only depend on `random_seed`, the messages and the number of calls
+    made so far, so a sequence of games replays identically.
+
+    :param latency: Simulated time to the first token, in seconds
+    :param prefill_latency: Simulated time to process each prompt token which
+        is not in the prefix cache, in seconds
+    :param token_latency: Simulated time to generate each token, in seconds
+    :param jitter: Uniform random extra latency, in seconds
+    :param error_rate: Probability of raising a `BackendError`
+    :param malformed_rate: Probability of answering without any hint
+    :param decorated_rate: Probability of formatting the hint with markdown,
+        a label or another separator
+    :param chatty_rate: Probability of explaining the hint after giving it
+    :param max_hint_num: Hint numbers are drawn between 1 and `max_hint_num`
+
+    When a `response_format` is requested, answers are always well-formed JSON
+    hints, as with the structured output of language model APIs. Like their
+    prompt caching, prompts starting with the same messages as a recent request
+    have these messages cached, reported in `Completion.cached_tokens`.
+    """
+
+    name = "mock"
+    models = ["mock-spymaster"]
+    decorations = [
+        "**{word}** - {num}",
+        "Hint: {word} – {num}",
+        "My hint is {word}-{num}.",
+        "{word} ({num})",
+    ]
+    max_cached_prefixes = 4096
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        prefill_latency: float = 0.0,
+        token_latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        decorated_rate: float = 0.0,
+        chatty_rate: float = 0.0,
+        max_hint_num: int = 3,
+        random_seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.prefill_latency = prefill_latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.decorated_rate = decorated_rate
+        self.chatty_rate = chatty_rate
+        self.max_hint_num = max_hint_num
+        self.random_seed = random_seed
+        self._num_calls = 0
+        self._lock = threading.Lock()
+        self._cached_prefixes = OrderedDict()
+
+    def list_models(self) -> List[str]:
+        return list(self.models)
+
+    def generate(
+        self, messages: List[Dict[str, str]], n: int = 1, structured: bool = False
+    ) -> Tuple[List[str], bool]:
+        """Return `n` deterministic answers to `messages` and whether an error
+        should be injected instead, without simulating latency"""
+        with self._lock:
+            self._num_calls += 1
+            num_calls = self._num_calls
+        digest = hashlib.blake2b(
+            json.dumps([self.random_seed, num_calls, messages]).encode(),
+            digest_size=8,
+        ).digest()
+        rng = random.Random(digest)
+        if rng.random() < self.error_rate:
+            return [""] * n, True
+        return [self._sample(rng, structured) for _ in range(n)], False
+
+    def _sample(self, rng: random.Random, structured: bool) -> str:
+        malformed = rng.random() < self.malformed_rate
+        word, num = f"CLUE{rng.randint(0, 999)}", rng.randint(1, self.max_hint_num)
+        if structured:
+            return json.dumps({"word": word, "number": num})
+        if malformed:
+            return "I would say the best hint here is a secret."
+        hint = f"{word} - {num}"
+        if rng.random() < self.decorated_rate:
+            hint = rng.choice(self.decorations).format(word=word, num=num)
+        if rng.random() < self.chatty_rate:
+            hint += (
+                "\n\nExplanation: this clue links several of your team's words"
+                " while staying far from your opponent's words, the neutral words"
+                " and most importantly the assassin. Good luck!"
+            )
+        return hint
+
+    def prompt_usage(self, messages: List[Dict[str, str]]) -> Tuple[int, int]:
+        """Return the number of prompt tokens of `messages`, and how many of them
+        are in the prefix cache, i.e. start with the same messages as a recent
+        request; `messages` are then cached"""
+        digest = hashlib.blake2b(digest_size=8)
+        prompt_tokens, cached_tokens = 0, 0
+        with self._lock:
+            for message in messages:
+                digest.update(json.dumps(message).encode())
+                prompt_tokens += len(message["content"]) // 4
+                key = digest.digest()
+                if key in self._cached_prefixes:
+                    self._cached_prefixes.move_to_end(key)
+                    cached_tokens = prompt_tokens
+                else:
+                    self._cached_prefixes[key] = None
+            while len(self._cached_prefixes) > self.max_cached_prefixes:
+                self._cached_prefixes.popitem(last=False)
+        return prompt_tokens, cached_tokens
+
+    def first_token_delay(self, uncached_tokens: int = 0) -> float:
+        """Simulated time to the first token, in seconds"""
+        return (
+            self.latency
+            + self.prefill_latency * uncached_tokens
+            + random.uniform(0, self.jitter)
+        )
+
+    def tokens(self, content: str) -> List[str]:
+        """Split `content` into the chunks streamed by the mock backend"""
+        return re.findall(r"\s*\S+", content)
+
+    def complete(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        n: int = 1,
+        response_format: Optional[Dict] = None,
+    ) -> Completion:
+        choices, error = self.generate(messages, n, response_format is not None)
+        prompt_tokens, cached_tokens = self.prompt_usage(messages)
+        # Choices are generated in parallel, as by a batching inference server
+        delay = self.first_token_delay(
+            prompt_tokens - cached_tokens
+        ) + self.token_latency * max(len(self.tokens(x)) for x in choices)
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            raise BackendError("Injected mock backend error")
+        return Completion(
+            content=choices[0],
+            prompt_tokens=prompt_tokens,
+            completion_tokens=sum(len(x) // 4 for x in choices),
+            cached_tokens=cached_tokens,
+            choices=choices,
+        )
+
+    def stream(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        response_format: Optional[Dict] = None,
+    ) -> Iterator[Union[str, Completion]]:
+        (content,), error = self.generate(
+            messages, structured=response_format is not None
+        )
+        prompt_tokens, cached_tokens = self.prompt_usage(messages)
+        delay = self.first_token_delay(prompt_tokens - cached_tokens)
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            raise BackendError("Injected mock backend error")
+        for token in self.tokens(content):
+            if self.token_latency > 0:
+                time.sleep(self.token_latency)
+            yield token
+        yield Completion(
+            content="",
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(content) // 4,
+            cached_tokens=cached_tokens,
+        )
+
+
+WORD_VECTORS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "word_vectors"
+)
+CLUE_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clue_index")
+
+
+def list_files(directory: str, ext: str) -> List[str]:
+    """Names of the files in `directory` with the given extension, without it"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(x[: -len(ext)] for x in os.listdir(directory) if x.endswith(ext))
+
+
+class WordVectorsBackend(SpymasterBackend):
+    """Builds the offline `EmbeddingSpymaster`, with the word vectors in
+    `word_vectors/` or the clue index in `clue_index/` of the board's language"""
+
+    name = "vectors"
+    models = ["word-vectors"]
+
+    def list_models(self) -> List[str]:
+        return self.models
+
+    def list_langs(self) -> List[str]:
+        """Languages with word vectors or a clue index"""
+        return sorted(
+            set(list_files(WORD_VECTORS_DIR, ".vec"))
+            | set(list_files(CLUE_INDEX_DIR, ".ids.npy"))
+        )
+
+    def supports_lang(self, lang: str, words: Optional[List[str]] = None) -> bool:
+        if os.path.exists(os.path.join(WORD_VECTORS_DIR, f"{lang}.vec")):
+            return True
+        # A clue index alone only covers the words lists it was built for
+        from clue_index import load_clue_index
+
+        index = load_clue_index(lang)
+        return index is not None and (words is None or index.covers(words))
+
+    def init_spymaster(
+        self,
+        model_name: str,
+        words: List[str],
+        team_assignment: List[int],
+        lang: str = "en",
+    ) -> "Spymaster":
+        from embedding_spymaster import init_embedding_spymaster
+
+        if not self.supports_lang(lang):
+            raise ValueError(f"No word vectors nor clue index for language {lang}")
+        return init_embedding_spymaster(lang, words, team_assignment)
+
+    def complete(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        n: int = 1,
+        response_format: Optional[Dict] = None,
+    ) -> Completion:
+        raise NotImplementedError("Hints are generated by EmbeddingSpymaster")
+
+
+BACKENDS = {
+    OpenAIBackend.name: "OpenAI",
+    OpenAICompatibleBackend.name: "OpenAI-compatible endpoint",
+    MockBackend.name: "Offline mock (no API calls)",
+    WordVectorsBackend.name: "Offline word vectors (no API calls)",
+}
+
+
+def get_backend(
+    backend_name: str, api_key: str = "", base_url: str = ""
+) -> SpymasterBackend:
+    """Build the backend with the given name (see `BACKENDS`)"""
+    if backend_name == OpenAIBackend.name:
+        return OpenAIBackend(api_key=api_key)
+    if backend_name == OpenAICompatibleBackend.name:
+        return OpenAICompatibleBackend(base_url=base_url, api_key=api_key)
+    if backend_name == MockBackend.name:
+        return MockBackend()
+    if backend_name == WordVectorsBackend.name:
+        return WordVectorsBackend()
+    raise ValueError(f"Unknown backend {backend_name}")
@@ -0,0 +1,292 @@
+"""Benchmarks of the engine and of the Game page reruns, offline against the mock
+backend, with results stored as JSON to compare runs and flag regressions
+
+Each benchmark runs until it has taken at least `--min-time` seconds, `--repeat`
+times, and reports the time of a call: the median and 95th percentile over the
+repeats. Setup steps (building a fresh game before each guess, for instance)
+are not timed.
+
+Example:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+    python benchmark.py --only give_hint give_hint_retries --repeat 20
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from backends import MockBackend
+from engine import Spymaster, generate_board, init_spymaster, load_word_pool
+from hint_cache import HintCache
+from selfplay import percentile
+from word_pool import WordPool
+
+GAME_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Game.py")
+# Games and hints saved by the benchmarked page, removed at exit
+CACHE_DIR = tempfile.TemporaryDirectory(prefix="codenames_benchmark_")
+
+
+@dataclass
+class Benchmark:
+    """A benchmark: `run(setup())` is timed, `setup` being called before every
+    run, untimed, if given"""
+
+    run: Callable[[Any], Any]
+    setup: Optional[Callable[[], Any]] = None
+
+
+def new_spymaster(
+    side_length: int = 5, seed: int = 0, backend: Optional[MockBackend] = None
+) -> Spymaster:
+    """Spymaster of a new game on the English words list, with the mock backend"""
+    words, team_assignment = generate_board(
+        load_word_pool("en"), side_length=side_length, random_seed=seed
+    )
+    backend = backend or MockBackend(random_seed=seed)
+    return init_spymaster(backend, backend.models[0], words, team_assignment)
+
+
+def long_game(num_turns: int = 200) -> Spymaster:
+    """Spymaster of a game on an 8x8 board where `num_turns` hints were given"""
+    spymaster = new_spymaster(side_length=8)
+    for _ in range(num_turns):
+        spymaster.give_hint()
+        spymaster.pass_turn()
+    return spymaster
+
+
+def bench_generate_board() -> Benchmark:
+    pool = WordPool(f"WORD{i:06d}" for i in range(100_000))
+    seeds = iter(range(10**9))
+    return Benchmark(lambda _: generate_board(pool, 8, next(seeds)))
+
+
+def bench_update_pool() -> Benchmark:
+    pool = WordPool(f"WORD{i:06d}" for i in range(100_000))
+    text = "\n".join(pool.words[1:]) + "\nNEWWORD"
+    return Benchmark(lambda _: pool.updated(text))
+
+
+def bench_prompt() -> Benchmark:
+    spymaster = new_spymaster()
+    return Benchmark(lambda _: spymaster.prompt)
+
+
+def bench_remove_play() -> Benchmark:
+    def setup() -> Tuple[Spymaster, str]:
+        spymaster = new_spymaster()
+        spymaster.set_hint("HINT", 3)
+        team = spymaster.current_team + 1
+        board = spymaster.board
+        word = next(w for w, c in zip(board.words, board.cards) if c == team)
+        return spymaster, word
+
+    def run(state: Tuple[Spymaster, str]) -> None:
+        spymaster, word = state
+        spymaster.remove(word, spymaster.current_team + 1)
+        spymaster.play()
+
+    return Benchmark(run, setup)
+
+
+def bench_give_hint(**mock: float) -> Callable[[], Benchmark]:
+    def make() -> Benchmark:
+        backend = MockBackend(random_seed=0, **mock)
+        return Benchmark(
+            lambda spymaster: spymaster.give_hint(),
+            lambda: new_spymaster(backend=backend),
+        )
+
+    return make
+
+
+def bench_get_history() -> Benchmark:
+    spymaster = long_game()
+    return Benchmark(lambda _: spymaster.get_history(spymaster.current_team))
+
+
+def bench_budgeted_request() -> Benchmark:
+    spymaster = long_game()
+    spymaster.use_history("budget")
+    return Benchmark(lambda _: spymaster.request_messages(spymaster.current_team))
+
+
+def bench_hint_cache_key() -> Benchmark:
+    spymaster = long_game()
+    messages = spymaster.request_messages(spymaster.current_team)
+    return Benchmark(lambda _: HintCache.key("mock", "mock-spymaster", 1.0, messages))
+
+
+def start_app_test(play: bool, timeout: float = 60.0):
+    """Game page run by Streamlit's test harness, at its setup screen or, if
+    `play`, in a game started with the mock backend. Its games and hints are
+    stored in a temporary directory, not with the saved ones."""
+    from streamlit.testing.v1 import AppTest
+
+    os.environ["CODENAMES_CACHE_DIR"] = CACHE_DIR.name
+    at = AppTest.from_file(GAME_PAGE, default_timeout=timeout)
+    if play:
+        at.run()
+        at.selectbox[0].set_value(MockBackend.name).run()
+        at.button[0].click().run()
+        next(b for b in at.button if b.label == "Start").click().run()
+        # Wait for the first hint, generated in the background
+        deadline = time.monotonic() + timeout
+        while any(b.disabled for b in at.button if "card_hidden" in (b.key or "")):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"No hint was given within {timeout:.0f} seconds")
+            time.sleep(0.01)
+            at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+    return at
+
+
+def bench_page_setup_screen() -> Benchmark:
+    return Benchmark(lambda at: at.run(), lambda: start_app_test(play=False))
+
+
+def bench_page_rerun() -> Benchmark:
+    at = start_app_test(play=True)
+    return Benchmark(lambda _: at.run())
+
+
+# Benchmarks by name, built only when selected
+BENCHMARKS: Dict[str, Callable[[], Benchmark]] = {
+    "generate_board": bench_generate_board,
+    "update_pool": bench_update_pool,
+    "prompt": bench_prompt,
+    "remove_play": bench_remove_play,
+    "give_hint": bench_give_hint(),
+    "give_hint_retries": bench_give_hint(malformed_rate=0.4, error_rate=0.2),
+    "get_history": bench_get_history,
+    "budgeted_request": bench_budgeted_request,
+    "hint_cache_key": bench_hint_cache_key,
+    "page_setup_screen": bench_page_setup_screen,
+    "page_rerun": bench_page_rerun,
+}
+
+
+def measure(benchmark: Benchmark, number: int) -> float:
+    """Total time of `number` runs, in seconds"""
+    total = 0.0
+    for _ in range(number):
+        state = benchmark.setup() if benchmark.setup is not None else None
+        start = time.perf_counter()
+        benchmark.run(state)
+        total += time.perf_counter() - start
+    return total
+
+
+def time_benchmark(
+    benchmark: Benchmark, repeat: int, min_time: float
+) -> Dict[str, float]:
+    """Statistics of the time of a run, in microseconds"""
+    # Find a number of runs taking at least `min_time`, which also warms up
+    number = 1
+    while measure(benchmark, number) < min_time and number < 10**6:
+        number *= 2
+    samples = [measure(benchmark, number) / number * 1e6 for _ in range(repeat)]
+    return {
+        "median_us": statistics.median(samples),
+        "p95_us": percentile(samples, 95),
+        "min_us": min(samples),
+        "mean_us": statistics.mean(samples),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def environment() -> Dict[str, str]:
+    """Description of where the benchmarks ran"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(GAME_PAGE),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]
+) -> Dict[str, float]:
+    """Relative change of the median time of the benchmarks found in both runs,
+    positive when slower"""
+    return {
+        name: results[name]["median_us"] / baseline[name]["median_us"] - 1
+        for name in results
+        if name in baseline
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--only", nargs="+", default=None, choices=list(BENCHMARKS), metavar="NAME"
+    )
+    parser.add_argument("--repeat", type=int, default=7, help="Timed repeats")
+    parser.add_argument(
+        "--min-time", type=float, default=0.05, help="Seconds per repeat, at least"
+    )
+    parser.add_argument("--output", default=None, help="Write the results there")
+    parser.add_argument("--compare", default=None, help="Results of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Slowdown of the median flagged as a regression, e.g. 0.2 for 20%%",
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results[name] = time_benchmark(BENCHMARKS[name](), args.repeat, args.min_time)
+        line = (
+            f"{name:<20} {results[name]['median_us']:>12.1f} us "
+            f"(p95 {results[name]['p95_us']:.1f} us, {results[name]['number']} runs)"
+        )
+        if name in baseline:
+            change = compare({name: results[name]}, baseline)[name]
+            flag = "  REGRESSION" if change > args.threshold else ""
+            line += f"  {change:+.1%}{flag}"
+        print(line, flush=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+    regressions = [
+        name
+        for name, change in compare(results, baseline).items()
+        if change > args.threshold
+    ]
+    if len(regressions):
+        print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compact board state, cheap to query and copy in headless simulations"""
+
+from array import array
+from typing import Dict, List, Sequence
+
+# Card types, as in the team assignments of `engine.generate_board`
+KILLER, NEUTRAL = -1, 0
+
+
+def popcount(mask: int) -> int:
+    """Number of bits set in `mask`, as `int.bit_count()` which needs Python 3.10"""
+    return bin(mask).count("1")
+
+
+class BoardState:
+    """Words of a board, their card types and which ones are still to guess
+
+    Words and card types never change during a game and are shared by all
+    copies; the words left are a bitmask, so that membership checks, removals,
+    counts and copies are O(1) and do not allocate lists.
+
+    :param words: Words on the board, at most 64
+    :param team_assignment: Card type of every word: -1 for the killer card,
+        0 for neutral cards, 1 and 2 for the teams
+    """
+
+    __slots__ = ("words", "cards", "index", "card_masks", "remaining")
+
+    def __init__(self, words: Sequence[str], team_assignment: Sequence[int]) -> None:
+        if len(words) != len(team_assignment) or len(words) > 64:
+            raise ValueError("Expected at most 64 words, each with a card type")
+        self.words = tuple(words)
+        self.cards = array("b", team_assignment)
+        self.index: Dict[str, int] = {w: i for i, w in enumerate(self.words)}
+        # Bitmask of the words of every card type, indexed by card type + 1
+        self.card_masks = [0, 0, 0, 0]
+        for i, card in enumerate(self.cards):
+            self.card_masks[card + 1] |= 1 << i
+        self.remaining = (1 << len(self.words)) - 1
+
+    def copy(self) -> "BoardState":
+        """Copy of the board, sharing the immutable words and card types"""
+        board = BoardState.__new__(BoardState)
+        board.words = self.words
+        board.cards = self.cards
+        board.index = self.index
+        board.card_masks = self.card_masks
+        board.remaining = self.remaining
+        return board
+
+    def __contains__(self, word: str) -> bool:
+        """Whether `word` is on the board and not guessed yet"""
+        i = self.index.get(word)
+        return i is not None and (self.remaining >> i) & 1 == 1
+
+    def __len__(self) -> int:
+        """Number of words left on the board"""
+        return popcount(self.remaining)
+
+    def card(self, word: str) -> int:
+        """Card type of a board word, guessed or not
+
+        :raises KeyError: if `word` is not on the board
+        """
+        return self.cards[self.index[word]]
+
+    def remove(self, word: str) -> int:
+        """Mark `word` as guessed and return its card type"""
+        i = self.index[word]
+        self.remaining &= ~(1 << i)
+        return self.cards[i]
+
+    def count(self, card: int) -> int:
+        """Number of words of the given card type left on the board"""
+        return popcount(self.remaining & self.card_masks[card + 1])
+
+    def found(self, card: int) -> int:
+        """Number of words of the given card type already guessed"""
+        return popcount(self.card_masks[card + 1] & ~self.remaining)
+
+    def words_of(self, card: int) -> List[str]:
+        """Words of the given card type left on the board, in board order"""
+        mask = self.remaining & self.card_masks[card + 1]
+        return [w for i, w in enumerate(self.words) if (mask >> i) & 1]
+
+    def is_left(self) -> List[bool]:
+        """Whether every board word is still to guess, in board order"""
+        return [(self.remaining >> i) & 1 == 1 for i in range(len(self.words))]
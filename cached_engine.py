@@ -0,0 +1,125 @@
+"""Streamlit-cached wrappers around the engine core, used by the app pages"""
+
+import logging
+import os
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+import streamlit as st
+
+import backends
+import engine
+from api_client import MAX_CLIENTS
+from backends import BackendError, SpymasterBackend
+from game_db import DEFAULT_GAME_DB_PATH, GameDB
+from game_store import GameStore
+from hint_cache import DEFAULT_HINT_CACHE_PATH, HintCache, SingleFlight
+from telemetry import serve_metrics
+from word_pool import WordPool
+
+
+def cache_path(default_path: str) -> str:
+    """Path of a database, moved to `$CODENAMES_CACHE_DIR` if set, e.g. to keep
+    benchmarks away from the saved games and hints"""
+    directory = os.environ.get("CODENAMES_CACHE_DIR")
+    if not directory:
+        return default_path
+    return os.path.join(directory, os.path.basename(default_path))
+
+
+@st.cache_data
+def get_lang_options() -> List[str]:
+    """Get available language options"""
+    return engine.get_lang_options()
+
+
+@st.cache_data
+def get_default_words_list(lang: str = "en") -> str:
+    """Returns the default list of words for the given language"""
+    return engine.get_default_words_list(lang)
+
+
+@st.cache_resource
+def get_word_pool(lang: str = "en") -> WordPool:
+    """Returns the pool of default words for the given language"""
+    return engine.load_word_pool(lang)
+
+
+# Bounded like the API clients, which backends hold with their API key
+@st.cache_resource(max_entries=MAX_CLIENTS)
+def get_spymaster_backend(
+    backend_name: str, api_key: str = "", base_url: str = ""
+) -> SpymasterBackend:
+    """Returns a spymaster backend"""
+    return backends.get_backend(backend_name, api_key=api_key, base_url=base_url)
+
+
+def get_backend(
+    backend_name: str, api_key: str = "", base_url: str = ""
+) -> Tuple[SpymasterBackend, List[str]]:
+    """Returns a spymaster backend and the list of models available with it,
+    which backends cache and refresh on their own. The list is empty if it could
+    not be fetched, the error being reported by `backend.models_status()`"""
+    backend = get_spymaster_backend(backend_name, api_key=api_key, base_url=base_url)
+    try:
+        return backend, backend.list_models()
+    except BackendError:
+        return backend, []
+
+
+# Pools are only hashed by their fingerprint
+@st.cache_data(hash_funcs={WordPool: lambda pool: pool.fingerprint})
+def generate_board(
+    pool: WordPool, side_length: int = 5, random_seed: int = 42
+) -> Tuple[List[str], List[int]]:
+    """Generate a board of `side_length**2` words"""
+    return engine.generate_board(pool, side_length, random_seed)
+
+
+@st.cache_resource
+def get_game_store() -> GameStore:
+    """Returns the registry of the games in progress of all sessions"""
+    return GameStore()
+
+
+@st.cache_resource
+def get_game_db() -> GameDB:
+    """Returns the database of the games of all sessions"""
+    return GameDB(cache_path(DEFAULT_GAME_DB_PATH))
+
+
+@st.cache_resource
+def get_hint_cache() -> HintCache:
+    """Returns the hint cache shared by all sessions"""
+    return HintCache(cache_path(DEFAULT_HINT_CACHE_PATH))
+
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """Returns the requests in flight shared by all sessions"""
+    return SingleFlight()
+
+
+@st.cache_resource
+def start_metrics_server() -> Optional[int]:
+    """Serve the metrics at `/metrics` on the port in `$CODENAMES_METRICS_PORT`,
+    if set, and return the port. Metrics are optional: if the port is invalid or
+    already in use, e.g. by another server process, a warning is logged and None
+    is returned."""
+    port = os.environ.get("CODENAMES_METRICS_PORT")
+    if not port:
+        return None
+    try:
+        serve_metrics(int(port))
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).warning(
+            "Not serving the metrics on port %r: %s", port, e
+        )
+        return None
+    return int(port)
+
+
+@st.cache_resource
+def start_preload() -> Future:
+    """Start loading, once per process, what the setup screen leads to"""
+    return engine.PREFETCH_EXECUTOR.submit(engine.preload)
@@ -0,0 +1,164 @@
+"""Precomputed clue index: the top-K clues associated to every word of a words list
+
+The index of a language is stored in `clue_index/` as
+  * `{lang}.words.txt`: the indexed (upper case) board words, one per line
+  * `{lang}.clues.txt`: the clue vocabulary, restricted to clues used in the index
+  * `{lang}.ids.npy`: array `(num_words, K)` of clue ids, sorted by similarity
+  * `{lang}.scores.npy`: float16 array `(num_words, K)` of the matching similarities
+The arrays are memory-mapped when loaded, so that all sessions of a server process
+share the same pages, and the word vectors never need to be loaded at game time.
+
+Example:
+    python clue_index.py --lang en --top-k 256
+"""
+
+import argparse
+import os
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from backends import CLUE_INDEX_DIR, WORD_VECTORS_DIR, list_files
+from embedding_spymaster import WordVectors, load_word_vectors
+from engine import load_word_pool
+
+
+class ClueIndex:
+    """Posting lists of the top-K clues of every indexed board word
+
+    :param words: Indexed board words (upper case)
+    :param clues: Clue vocabulary (lower case)
+    :param ids: Clue ids of shape `(len(words), K)`
+    :param scores: Similarities of shape `(len(words), K)`, sorted decreasingly
+    """
+
+    def __init__(
+        self, words: List[str], clues: List[str], ids: np.ndarray, scores: np.ndarray
+    ) -> None:
+        self.words = words
+        self.clues = clues
+        self.ids = ids
+        self.scores = scores
+        self.rows = {w: i for i, w in enumerate(words)}
+
+    @classmethod
+    def load(cls, lang: str, index_dir: str = CLUE_INDEX_DIR) -> "ClueIndex":
+        """Load an index built by `build_clue_index`, memory-mapping the arrays"""
+        path = os.path.join(index_dir, lang)
+        with open(f"{path}.words.txt", "r", encoding="utf-8") as open_file:
+            words = open_file.read().splitlines()
+        with open(f"{path}.clues.txt", "r", encoding="utf-8") as open_file:
+            clues = open_file.read().splitlines()
+        return cls(
+            words,
+            clues,
+            np.load(f"{path}.ids.npy", mmap_mode="r"),
+            np.load(f"{path}.scores.npy", mmap_mode="r"),
+        )
+
+    def save(self, lang: str, index_dir: str = CLUE_INDEX_DIR) -> None:
+        """Write the index to `index_dir`"""
+        os.makedirs(index_dir, exist_ok=True)
+        path = os.path.join(index_dir, lang)
+        with open(f"{path}.words.txt", "w", encoding="utf-8") as open_file:
+            open_file.write("\n".join(self.words))
+        with open(f"{path}.clues.txt", "w", encoding="utf-8") as open_file:
+            open_file.write("\n".join(self.clues))
+        np.save(f"{path}.ids.npy", self.ids)
+        np.save(f"{path}.scores.npy", self.scores)
+
+    def covers(self, words: List[str]) -> bool:
+        """Whether all the given board words are indexed"""
+        return all(w in self.rows for w in words)
+
+    def candidate_sims(
+        self, words: List[str], is_slf: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Candidate clues for a board and their similarities to all its words
+
+        Candidates are the union of the posting lists of the team's words. When a
+        candidate is missing from the posting list of a word, its similarity is
+        unknown but lower than the last score of the list: we use that upper bound
+        for words to avoid, and -1 for team words, so that the estimate is always
+        conservative.
+
+        :param words: Board words left
+        :param is_slf: Boolean mask of `words` belonging to the team to hint for
+        :return: Candidate clue ids, and their similarities of shape
+            `(num_candidates, len(words))`
+        """
+        rows = [self.rows.get(w) for w in words]
+        team_rows = [r for r, s in zip(rows, is_slf) if s and r is not None]
+        if not len(team_rows):
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(words)), np.float32)
+        candidates = np.unique(np.asarray(self.ids[team_rows]).ravel())
+        sims = np.empty((len(candidates), len(words)), dtype=np.float32)
+        for j, (row, slf) in enumerate(zip(rows, is_slf)):
+            if row is None:
+                sims[:, j] = -1.0 if slf else 0.0
+                continue
+            ids, scores = self.ids[row], self.scores[row]
+            sims[:, j] = -1.0 if slf else scores[-1]
+            pos = np.searchsorted(candidates, ids)
+            found = pos < len(candidates)
+            found[found] = candidates[pos[found]] == ids[found]
+            sims[pos[found], j] = scores[found]
+        return candidates, sims
+
+
+def build_clue_index(
+    words: List[str], vectors: WordVectors, top_k: int = 256, batch_size: int = 64
+) -> ClueIndex:
+    """Build the index of the `top_k` best clues of every word in `words`"""
+    top_k = min(top_k, len(vectors.vocab) - 1)
+    top_ids = np.empty((len(words), top_k), dtype=np.int64)
+    top_scores = np.empty((len(words), top_k), dtype=np.float32)
+    for start in range(0, len(words), batch_size):
+        batch = words[start : start + batch_size]
+        sims = vectors.lookup(batch) @ vectors.vectors.T
+        for i, word in enumerate(batch):
+            sims[i, vectors.exclusion_mask([word])] = -np.inf
+        ids = np.argpartition(-sims, top_k, axis=1)[:, :top_k]
+        scores = np.take_along_axis(sims, ids, axis=1)
+        order = np.argsort(-scores, axis=1)
+        top_ids[start : start + len(batch)] = np.take_along_axis(ids, order, axis=1)
+        top_scores[start : start + len(batch)] = np.take_along_axis(
+            scores, order, axis=1
+        )
+
+    # Only keep the clues used in the index, with the most compact id type
+    used, remapped = np.unique(top_ids, return_inverse=True)
+    dtype = np.uint16 if len(used) <= np.iinfo(np.uint16).max else np.int32
+    return ClueIndex(
+        words,
+        [vectors.vocab[i] for i in used],
+        remapped.reshape(top_ids.shape).astype(dtype),
+        # Excluded clues only fill lists of words with few valid clues
+        np.maximum(top_scores, -1.0).astype(np.float16),
+    )
+
+
+@lru_cache(maxsize=None)
+def load_clue_index(lang: str) -> Optional[ClueIndex]:
+    """Load (once per process) the clue index of a language, if it was built"""
+    if not os.path.exists(os.path.join(CLUE_INDEX_DIR, f"{lang}.ids.npy")):
+        return None
+    return ClueIndex.load(lang)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lang", nargs="+", default=None, help="Defaults to all")
+    parser.add_argument("--top-k", type=int, default=256)
+    args = parser.parse_args()
+
+    for lang in args.lang or list_files(WORD_VECTORS_DIR, ".vec"):
+        words = list(load_word_pool(lang).words)
+        index = build_clue_index(words, load_word_vectors(lang), top_k=args.top_k)
+        index.save(lang)
+        print(f"{lang}: indexed {len(words)} words with {len(index.clues)} clues")
+
+
+if __name__ == "__main__":
+    main()
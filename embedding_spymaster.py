@@ -0,0 +1,264 @@
+"""Offline spymaster choosing hints from word vectors, without any API call
+
+Word vectors are read from `word_vectors/{lang}.vec`, in the text format used by
+word2vec, fastText or GloVe (one word per line followed by its coordinates,
+optionally preceded by a `num_words dim` header line). For instance, the fastText
+`cc.{lang}.300.vec` files can be used directly.
+"""
+
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backends import WORD_VECTORS_DIR, Completion
+from engine import Spymaster
+
+if TYPE_CHECKING:
+    from clue_index import ClueIndex
+
+
+class WordVectors:
+    """Unit-normalized word vectors of a language
+
+    :param vocab: Lowercase words, ideally sorted by decreasing frequency
+    :param vectors: Array of shape `(len(vocab), dim)`
+    """
+
+    def __init__(self, vocab: List[str], vectors: np.ndarray) -> None:
+        self.vocab = vocab
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = (vectors / np.maximum(norms, 1e-8)).astype(np.float32)
+        self.index = {w: i for i, w in enumerate(vocab)}
+        # Only propose clues which are single plain words
+        self.clue_mask = np.array([w.isalpha() and len(w) > 2 for w in vocab])
+        self.prefix_index = {}
+        for i, w in enumerate(vocab):
+            self.prefix_index.setdefault(w[:3], []).append(i)
+
+    @classmethod
+    def from_file(cls, path: str, max_words: Optional[int] = 50000) -> "WordVectors":
+        """Read word vectors in text format, keeping the first `max_words` words"""
+        vocab, vectors, seen = [], [], set()
+        with open(path, "r", encoding="utf-8", errors="ignore") as open_file:
+            for line in open_file:
+                parts = line.rstrip().split(" ")
+                # Skip the optional header and malformed lines
+                if len(parts) < 3 or (len(vectors) and len(parts) != dim + 1):
+                    continue
+                word = parts[0].lower()
+                if word in seen:
+                    continue
+                seen.add(word)
+                vocab.append(word)
+                vectors.append(np.asarray(parts[1:], dtype=np.float32))
+                dim = len(parts) - 1
+                if max_words is not None and len(vocab) >= max_words:
+                    break
+        return cls(vocab, np.stack(vectors))
+
+    def lookup(self, words: List[str]) -> np.ndarray:
+        """Return the unit vectors of board `words`; words made of several tokens
+        (e.g. "ICE CREAM") are averaged and unknown words map to zero"""
+        out = np.zeros((len(words), self.vectors.shape[1]), dtype=np.float32)
+        for i, word in enumerate(words):
+            ids = [
+                self.index[x]
+                for x in word.lower().replace("-", " ").split()
+                if x in self.index
+            ]
+            if len(ids):
+                v = self.vectors[ids].mean(axis=0)
+                out[i] = v / max(np.linalg.norm(v), 1e-8)
+        return out
+
+    def exclusion_mask(self, words: List[str]) -> np.ndarray:
+        """Mask of the vocabulary words which are not valid clues for a board
+        with the given `words`, i.e. equal to, or a prefix of, one of their tokens
+        (or the reverse, e.g. plurals)"""
+        mask = ~self.clue_mask
+        for word in words:
+            for t in word.lower().replace("-", " ").split():
+                for i in self.prefix_index.get(t[:3], []):
+                    if self.vocab[i].startswith(t) or t.startswith(self.vocab[i]):
+                        mask[i] = True
+        return mask
+
+
+@lru_cache(maxsize=None)
+def load_word_vectors(lang: str) -> WordVectors:
+    """Load (once per process) the word vectors for the given language"""
+    return WordVectors.from_file(os.path.join(WORD_VECTORS_DIR, f"{lang}.vec"))
+
+
+def score_clues(
+    sims: np.ndarray,
+    team_assignment: np.ndarray,
+    team: int,
+    max_hint_num: int = 4,
+    min_margin: float = 0.05,
+    kll_penalty: float = 0.1,
+    ntr_weight: float = 0.9,
+) -> np.ndarray:
+    """Score every (clue, number) pair for all candidate clues at once
+
+    :param sims: Cosine similarities of shape `(num_clues, num_words)` between
+        every candidate clue and every word left on the board
+    :param team_assignment: Card type of every word left on the board
+    :param team: Card type of the team to give a hint to (1 or 2)
+    :param max_hint_num: Largest number of words a single clue can target
+    :param min_margin: Required gap between the least similar targeted word and
+        the most similar word to avoid
+    :param kll_penalty: Extra margin required w.r.t. the killer card
+    :param ntr_weight: Neutral cards are less costly to guess than the others
+    :return: Array of shape `(num_clues, max_hint_num)`, where entry `(c, k)` is
+        the score of hinting clue `c` for `k + 1` words, or -inf if not valid
+    """
+    is_slf = team_assignment == team
+    slf = -np.sort(-sims[:, is_slf], axis=1)[:, :max_hint_num]
+    bad = np.full(len(sims), -1.0, dtype=sims.dtype)
+    for card, weight, offset in [
+        (3 - team, 1.0, 0.0),
+        (0, ntr_weight, 0.0),
+        (-1, 1.0, kll_penalty),
+    ]:
+        cols = team_assignment == card
+        if cols.any():
+            bad = np.maximum(bad, sims[:, cols].max(axis=1) * weight + offset)
+    margin = slf - bad[:, None]
+    # Reward targeting more words, then larger margins
+    scores = np.arange(1, slf.shape[1] + 1)[None, :] + margin
+    return np.where(margin > min_margin, scores, -np.inf)
+
+
+class EmbeddingSpymaster(Spymaster):
+    """Spymaster scoring candidate clues against the board in one matrix
+    product, answering in milliseconds without any API call
+
+    :param vectors: Word vectors, used to score every word of their vocabulary
+    :param index: Precomputed clue index; when it covers the board, candidate
+        clues are only drawn from the posting lists of the team's words and
+        `vectors` are not needed
+    """
+
+    is_remote = False
+
+    def __init__(
+        self,
+        vectors: Optional[WordVectors],
+        model_name: str = "word-vectors",
+        index: Optional["ClueIndex"] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(None, model_name, **kwargs)
+        self.vectors = vectors
+        self.index = index
+        self.rng = np.random.default_rng(0)
+        # Clues already given, as found in the vocabulary: upper casing is not
+        # always reversible, e.g. "straße" is given as "STRASSE"
+        self.given_clues = set()
+
+    def update_words(self, words: List[str], team_assignment: List[int]) -> None:
+        super().update_words(words, team_assignment)
+        self.board_teams = np.asarray(team_assignment)
+        if self.index is not None and self.index.covers(words):
+            self.board_tokens = {}
+            for word in words:
+                for t in word.lower().replace("-", " ").split():
+                    self.board_tokens.setdefault(t[:3], []).append(t)
+        else:
+            self.index = None
+            self.board_vectors = self.vectors.lookup(words)
+            self.excluded = self.vectors.exclusion_mask(words)
+
+    def is_excluded(self, clue: str) -> bool:
+        """Whether `clue` is a board word, a prefix of one, or was already given"""
+        return clue in self.given_clues or any(
+            clue.startswith(t) or t.startswith(clue)
+            for t in self.board_tokens.get(clue[:3], [])
+        )
+
+    def candidate_sims(
+        self, on_board: np.ndarray
+    ) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Return candidate clues, their similarities to the words left on the
+        board, and the mask of invalid candidates"""
+        if self.index is not None:
+            words_left = [w for w, x in zip(self.board.words, on_board) if x]
+            is_slf = self.board_teams[on_board] == self.current_team + 1
+            ids, sims = self.index.candidate_sims(words_left, is_slf)
+            clues = [self.index.clues[i] for i in ids]
+            return clues, sims, np.array([self.is_excluded(c) for c in clues], bool)
+
+        excluded = self.excluded.copy()
+        excluded[
+            [self.vectors.index[x] for x in self.given_clues if x in self.vectors.index]
+        ] = True
+        sims = self.vectors.vectors @ self.board_vectors[on_board].T
+        return self.vectors.vocab, sims, excluded
+
+    def best_hint(self) -> Tuple[str, int]:
+        """Return the best clue for the current team, as found in the vocabulary,
+        and its number"""
+        on_board = np.array(self.board.is_left())
+        clues, sims, excluded = self.candidate_sims(on_board)
+        teams = self.board_teams[on_board]
+        scores = score_clues(sims, teams, self.current_team + 1)
+        scores[excluded] = -np.inf
+
+        flat = scores.ravel()
+        if not np.isfinite(flat).any():
+            # No clue passes the margin: fall back to the closest clue to one word
+            best_single = sims[:, teams == self.current_team + 1].max(axis=1)
+            best_single[excluded] = -np.inf
+            if not len(best_single) or not np.isfinite(best_single).any():
+                raise ValueError("No valid clue for this board")
+            return clues[int(np.argmax(best_single))], 1
+
+        # Sample among the best candidates when the temperature is positive
+        if self.temperature > 0:
+            top = (
+                np.argpartition(-flat, 10)[:10]
+                if flat.size > 10
+                else np.arange(flat.size)
+            )
+            top = top[np.isfinite(flat[top])]
+            logits = (flat[top] - flat[top].max()) / self.temperature
+            probs = np.exp(logits) / np.exp(logits).sum()
+            idx = int(self.rng.choice(top, p=probs))
+        else:
+            idx = int(np.argmax(flat))
+        clue, num = divmod(idx, scores.shape[1])
+        return clues[clue], num + 1
+
+    def complete(self, messages: List[Dict[str, str]], n: int = 1) -> Completion:
+        """Answer with the best clue in the `WORD - NUMBER` format"""
+        clue, hint_num = self.best_hint()
+        self.given_clues.add(clue)
+        return Completion(content=f"{clue.upper()} - {hint_num}")
+
+
+def init_embedding_spymaster(
+    lang: str, words: List[str], team_assignment: List[int]
+) -> EmbeddingSpymaster:
+    """Init an embedding spymaster for the given board, using the clue index of
+    the language when it covers the board, and the full word vectors otherwise
+
+    :raises ValueError: if the index does not cover the board and there are no
+        word vectors, e.g. for a custom words list
+    """
+    from clue_index import load_clue_index
+
+    index = load_clue_index(lang)
+    if index is not None and index.covers(words):
+        spymaster = EmbeddingSpymaster(None, lang, index=index)
+    elif not os.path.exists(os.path.join(WORD_VECTORS_DIR, f"{lang}.vec")):
+        raise ValueError(
+            "The clue index does not cover this words list, and there are no word "
+            f"vectors for {lang} to fall back on"
+        )
+    else:
+        spymaster = EmbeddingSpymaster(load_word_vectors(lang), lang)
+    spymaster.update_words(words, team_assignment)
+    return spymaster
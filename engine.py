@@ -1,10 +1,37 @@
 import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Tuple
-
-import streamlit as st
-from openai import OpenAI
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from backends import (
+    BackendError,
+    Completion,
+    SpymasterBackend,
+)
+from board import KILLER, NEUTRAL, BoardState
+from game_db import GUESS, HINT, PASS, Move
+from hint_cache import HintCache, RequestCancelled, SingleFlight
+from hint_parser import (
+    HINT_RESPONSE_FORMAT,
+    PARSE_STATS,
+    parse_hint,
+    parse_streamed_hint,
+)
+from telemetry import METRICS
+from word_pool import WordPool
+
+if TYPE_CHECKING:
+    from game_db import GameDB
 
 DEFAULT_SPYMASTER_PROMPT = """The words to guess on your team are: {SLF}.
 The words on your opponent's team NOT to guess are: {NTR}.
@@ -17,8 +44,31 @@ Give me your best hint."""
 DEFAULT_SPYMASTER_INSTRUCT = """You are playing Codenames as a bold and creative spymaster giving hints.
 Your answers should be in the format WORD - NUMBER."""
 
+# Sent right after the instruct: it does not change during a game, so that all
+# requests of a game share a long prefix, cached by most inference providers
+DEFAULT_SPYMASTER_RULES = """A hint is a single word which is not one of the words on the board, and the number of your team's words it relates to.
+The words on the board for the whole game are: {WORDS}."""
+
 DEFAULT_SPYMASTER_TEMPERATURE = 0.9
 
+# How much of the chat history is sent with each request
+HISTORY_MODES = {
+    "whole": "Whole history",
+    "last": "Last prompt only",
+    "budget": "Recent turns and a summary of older ones, within a token budget",
+}
+DEFAULT_HISTORY_BUDGET = 1000
+DEFAULT_HISTORY_TURNS = 2
+
+GUESS_PREFIX = "Your teammate picked "
+
+# Replaces the prompts of earlier turns in requests: the current prompt lists
+# the words left, so repeating every past board would only grow requests
+EARLIER_PROMPT = "Give me your best hint."
+
+DEFAULT_SIDE_LENGTH = 5
+SIDE_LENGTHS = [4, 5, 6, 7, 8]
+
 FULL_LANGUAGES = {
     "cz": "Czech",
     "de": "German",
@@ -28,58 +78,93 @@ FULL_LANGUAGES = {
     "it": "Italian",
 }
 
+WORDS_LISTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "words_lists"
+)
+
+# Thread pools shared by all games to generate hints in the background: the
+# hints players are waiting for, and the ones prefetched in case they are needed
+# next, which cannot hold up the former. Their threads mostly wait for the API,
+# or for the request of another game (see `SingleFlight`).
+HINT_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix="hint")
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="prefetch")
+
+
+class HintCancelled(RequestCancelled):
+    """Raised while streaming a hint generated in the background which is no
+    longer needed, to stop its generation"""
+
 
-@st.cache_data
 def get_lang_options() -> List[str]:
     """Get available language options"""
-    return [x[:-4] for x in os.listdir("words_lists") if x.endswith(".txt")]
+    return sorted(x[:-4] for x in os.listdir(WORDS_LISTS_DIR) if x.endswith(".txt"))
 
 
-@st.cache_data
-def get_default_words_list(lang: str = "en") -> List[str]:
+def get_default_words_list(lang: str = "en") -> str:
     """Returns the default list of words for the given language"""
-    with open(os.path.join("words_lists", f"{lang}.txt"), "r") as open_file:
+    with open(os.path.join(WORDS_LISTS_DIR, f"{lang}.txt"), "r") as open_file:
         words_list = open_file.read().upper()
     return words_list
 
 
-@st.cache_resource
-def get_openai_client(api_key: str) -> OpenAI:
-    """Returns an OpenAI client"""
-    client = OpenAI(api_key=api_key)
-    available_models = [x.id for x in client.models.list()]
-    return client, available_models
+@lru_cache(maxsize=None)
+def load_word_pool(lang: str = "en") -> WordPool:
+    """Load (once per process) the pool of default words of the given language"""
+    return WordPool.from_text(get_default_words_list(lang))
+
+
+def preload() -> None:
+    """Load what the first screens need next, to be run in the background on
+    cold starts: the default words lists and the OpenAI client library, which
+    is only imported once an OpenAI backend is used"""
+    for lang in get_lang_options():
+        load_word_pool(lang)
+    try:
+        import openai  # noqa: F401
+    except ImportError:
+        pass
+
+
+def team_composition(num_words: int) -> Dict[int, int]:
+    """Number of words of every card type on a board of `num_words` words
+
+    This scales the 1 killer, 7 neutral, 8 and 9 team words of the 5x5 board;
+    the starting team (card type 2) always has one more word than the other.
+    """
+    num_killers = max(1, round(num_words / 25))
+    num_first = round(num_words * 9 / 25)
+    return {
+        -1: num_killers,
+        0: num_words - num_killers - 2 * num_first + 1,
+        1: num_first - 1,
+        2: num_first,
+    }
 
 
-@st.cache_data
 def generate_board(
-    words_list: List[str], side_length: int = 5, random_seed: int = 42
+    pool: WordPool, side_length: int = DEFAULT_SIDE_LENGTH, random_seed: int = 42
 ) -> Tuple[List[str], List[int]]:
-    """Generate a board of `side_length**2` words"""
-    words_list = [x.strip() for x in words_list.splitlines() if len(x.strip())]
-    random.seed(random_seed)
-    random.shuffle(words_list)
-    # TODO: Adapt number of cards to larger board
-    team_assignment = [-1] * 1 + [0] * 7 + [1] * 8 + [2] * (side_length**2 - 16)
-    random.shuffle(team_assignment)
-    return words_list[: side_length**2], team_assignment
-
-
-def generate_spymaster_prompt(
-    words: List[str], team_assignment: List[int]
-) -> Tuple[List[str], List[str], List[str], List[str]]:
-    """ "Separate words on the board in their respective teams"""
-    SLF, OPP, NTR, KLL = [], [], [], []
-    for idx, (w, a) in enumerate(zip(words, team_assignment)):
-        if a == -1:
-            KLL.append(w)
-        elif a == 0:
-            NTR.append(w)
-        elif a == 1:
-            OPP.append(w)
-        elif a == 2:
-            SLF.append(w)
-    return SLF, OPP, NTR, KLL
+    """Generate a board of `side_length**2` words drawn from `pool`
+
+    The board only depends on the pool content and `random_seed`, and uses its
+    own random generator so that concurrent games do not interfere with each
+    other.
+    """
+    rng = random.Random(random_seed)
+    words = rng.sample(pool.words, side_length**2)
+    team_assignment = [
+        card
+        for card, num in team_composition(side_length**2).items()
+        for _ in range(num)
+    ]
+    rng.shuffle(team_assignment)
+    return words, team_assignment
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Rough number of tokens of chat `messages`: about 4 characters per token,
+    plus the formatting overhead of each message"""
+    return sum(4 + len(x["content"]) // 4 for x in messages)
 
 
 class MessageType(Enum):
@@ -94,11 +179,19 @@ class MessageType(Enum):
 class Spymaster:
     """Base Spymaster type"""
 
+    # Whether hints come from a remote backend, hence are worth caching,
+    # prefetching and streaming
+    is_remote = True
+
     def __init__(
-        self, client, model_name: str, use_last_prompt_only: bool = False
+        self,
+        backend: SpymasterBackend,
+        model_name: str,
+        use_last_prompt_only: bool = False,
     ) -> None:
-        self.client = client
+        self.backend = backend
         self.model_name = model_name
+        self.num_requests = 0
         self._prompt = DEFAULT_SPYMASTER_PROMPT
         self.current_hint_word = None
         self.og_hint_num = 0
@@ -113,12 +206,60 @@ class Spymaster:
             ]
             for _ in range(2)
         ]
-        self.use_last_prompt_only = use_last_prompt_only
+        self.history_mode = "last" if use_last_prompt_only else "whole"
+        self.history_budget = DEFAULT_HISTORY_BUDGET
+        self.history_turns = DEFAULT_HISTORY_TURNS
+        self.token_usage = {
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+            "last_prompt_tokens": 0,
+            "last_cached_tokens": 0,
+            # Requests whose usage was not reported but estimated, the cached
+            # tokens being unknown
+            "estimated_requests": 0,
+            "last_estimated": False,
+        }
         self.current_team = 1
+        self.hint_cache = None
+        self.single_flight = None
+        self.prefetch_enabled = False
+        self._prefetched = {}
+        self.partial_hints: Dict[int, str] = {}
+        self.streaming = False
+        self.num_candidates = 1
+        self.structured_output = False
+        self.game_db = None
+        self.game_id = None
+
+    @property
+    def backend_name(self) -> str:
+        """Name of the backend generating hints"""
+        return getattr(self.backend, "name", type(self).__name__)
 
     def words(self, team: int) -> List[str]:
         """Return words belonging to the given team and still on the board"""
-        return self.slf if team == 1 else self.opp
+        return self.board.words_of(team + 1)
+
+    @property
+    def slf(self) -> List[str]:
+        """Words of the second team still on the board"""
+        return self.board.words_of(2)
+
+    @property
+    def opp(self) -> List[str]:
+        """Words of the first team still on the board"""
+        return self.board.words_of(1)
+
+    @property
+    def ntr(self) -> List[str]:
+        """Neutral words still on the board"""
+        return self.board.words_of(NEUTRAL)
+
+    @property
+    def kll(self) -> List[str]:
+        """Killer word, if not guessed yet"""
+        return self.board.words_of(KILLER)
 
     def get_history(self, team: int) -> str:
         """Return chat history for the given team with markdown formatting"""
@@ -132,9 +273,11 @@ class Spymaster:
 
     def update_words(self, words: List[str], team_assignment: List[int]) -> None:
         """Update the words and team assignments"""
-        self.slf, self.opp, self.ntr, self.kll = generate_spymaster_prompt(
-            words, team_assignment
-        )
+        self.board = BoardState(words, team_assignment)
+        self.rules = {
+            "role": "user",
+            "content": DEFAULT_SPYMASTER_RULES.format(WORDS=", ".join(words)),
+        }
 
     def update_prompt(self, prompt: str) -> None:
         """Update the prompt template"""
@@ -148,20 +291,332 @@ class Spymaster:
     def update_temperature(self, t: float) -> None:
         self.temperature = t
 
-    def use_whole_history(self, enabled: bool) -> None:
-        """Whether to use the whole chat history or not"""
-        self.use_last_prompt_only = not enabled
+    def use_hint_cache(self, hint_cache: Optional[HintCache]) -> None:
+        """Reuse hints from the given cache for identical requests (None to disable)"""
+        self.hint_cache = hint_cache if self.is_remote else None
+
+    def use_game_db(self, game_db: Optional["GameDB"], game_id: str = "") -> None:
+        """Record every move under `game_id` in the given database (None to
+        disable), so that the game can be restored with `replay`"""
+        self.game_db = game_db
+        self.game_id = game_id
+
+    def record(self, move: Move) -> None:
+        """Record a move in the game database, if any"""
+        if self.game_db is not None:
+            self.game_db.record(
+                self.game_id, move, self.board.remaining, self.current_team
+            )
+
+    def replay(self, moves: List[Move]) -> None:
+        """Play again the moves of a stored game, without generating hints"""
+        for kind, word, num in moves:
+            if kind == HINT:
+                team = self.current_team
+                prompt = self.request_messages(team)[-1]
+                self.chat_history[team].append((MessageType.Prompt, prompt))
+                self.set_hint(word, num)
+            elif kind == GUESS:
+                self.remove(word, self.board.card(word))
+            elif kind == PASS:
+                self.end_turn()
+
+    def use_single_flight(self, single_flight: Optional[SingleFlight]) -> None:
+        """Share identical requests in flight with other games through
+        `single_flight` (None to disable)"""
+        self.single_flight = single_flight if self.is_remote else None
+
+    def use_streaming(self, enabled: bool) -> None:
+        """Whether to stream hints, stopping generation as soon as a hint is complete"""
+        self.streaming = enabled and self.is_remote
+
+    def use_candidates(self, num_candidates: int) -> None:
+        """Number of hints sampled in a single request, the best valid one being
+        kept; sequential retries are only used when none is valid"""
+        self.num_candidates = max(1, num_candidates) if self.is_remote else 1
+
+    def use_structured_output(self, enabled: bool) -> None:
+        """Whether to constrain answers to a JSON hint, for backends supporting
+        structured output"""
+        self.structured_output = enabled and self.is_remote
 
     @property
-    def prompt(self) -> str:
-        """Format prompt with the current words"""
+    def response_format(self) -> Optional[Dict]:
+        """Response format requested to the backend, if any"""
+        return HINT_RESPONSE_FORMAT if self.structured_output else None
+
+    def use_history(
+        self,
+        mode: str,
+        budget: int = DEFAULT_HISTORY_BUDGET,
+        num_turns: int = DEFAULT_HISTORY_TURNS,
+    ) -> None:
+        """How much of the chat history to send with each request
+
+        :param mode: One of `HISTORY_MODES`
+        :param budget: In "budget" mode, maximum estimated number of tokens of
+            a request
+        :param num_turns: In "budget" mode, number of last turns kept verbatim
+            when they fit in the budget; older turns are summarized
+        """
+        if mode not in HISTORY_MODES:
+            raise ValueError(f"Unknown history mode {mode}")
+        self.history_mode = mode
+        self.history_budget = budget
+        self.history_turns = num_turns
+
+    def prompt_for(self, team: int) -> str:
+        """Format prompt with the current words, from the point of view of `team`"""
         return self._prompt.format(
-            SLF=", ".join(self.words(self.current_team)),
-            OPP=", ".join(self.words(1 - self.current_team)),
+            SLF=", ".join(self.words(team)),
+            OPP=", ".join(self.words(1 - team)),
             NTR=", ".join(self.ntr),
             KLL=", ".join(self.kll),
         )
 
+    @property
+    def prompt(self) -> str:
+        """Format prompt with the current words"""
+        return self.prompt_for(self.current_team)
+
+    def board_snapshot(self) -> BoardState:
+        """Copy of the board, unaffected by later guesses"""
+        return self.board.copy()
+
+    @staticmethod
+    def sent_message(msg_type: MessageType, message: Dict[str, str]) -> Dict[str, str]:
+        """Message sent in requests for an entry of the chat history: prompts of
+        earlier turns are replaced by `EARLIER_PROMPT`, so that requests only
+        grow with the number of hints and guesses, and not with the board size"""
+        if msg_type == MessageType.Prompt:
+            return {"role": "user", "content": EARLIER_PROMPT}
+        return message
+
+    def turns(self, team: int) -> List[List[Tuple[MessageType, Dict[str, str]]]]:
+        """Split the chat history of `team`, after the instruct, in turns each
+        starting with a prompt"""
+        turns = []
+        for msg_type, message in self.chat_history[team][1:]:
+            if msg_type == MessageType.Prompt or not len(turns):
+                turns.append([])
+            turns[-1].append((msg_type, message))
+        return turns
+
+    def summarize_turn(
+        self, team: int, turn: List[Tuple[MessageType, Dict[str, str]]]
+    ) -> str:
+        """One line summary of a past turn of `team`: its hint and the outcome of
+        every pick"""
+        hint, picks = "no hint", []
+        for msg_type, message in turn:
+            if msg_type == MessageType.Hint:
+                hint = message["content"]
+            elif msg_type == MessageType.Guess:
+                word = message["content"][len(GUESS_PREFIX) :]
+                card = self.board.card(word)
+                outcome = (
+                    "correct"
+                    if card == team + 1
+                    else {0: "neutral", -1: "assassin"}.get(card, "opponent")
+                )
+                picks.append(f"{word} ({outcome})")
+        return f"- {hint}: " + (", ".join(picks) if len(picks) else "no pick")
+
+    def budgeted_history(self, team: int, budget: int) -> List[Dict[str, str]]:
+        """The last turns of `team` verbatim, preceded by a summary of the older
+        ones, fitting in `budget` estimated tokens
+
+        Recent turns which do not fit are summarized, then the oldest lines of
+        the summary are dropped.
+        """
+        turns = self.turns(team)
+        num_recent = min(self.history_turns, len(turns))
+        lines = [self.summarize_turn(team, x) for x in turns[: len(turns) - num_recent]]
+        recent = [
+            [self.sent_message(*x) for x in turn]
+            for turn in turns[len(turns) - num_recent :]
+        ]
+
+        def summary() -> List[Dict[str, str]]:
+            if not len(lines):
+                return []
+            return [
+                {
+                    "role": "user",
+                    "content": "Your previous hints and your teammate's picks:\n"
+                    + "\n".join(lines),
+                }
+            ]
+
+        recent_tokens = sum(estimate_tokens(x) for x in recent)
+        while len(recent) and estimate_tokens(summary()) + recent_tokens > budget:
+            recent_tokens -= estimate_tokens(recent.pop(0))
+            lines.append(self.summarize_turn(team, turns[len(turns) - num_recent]))
+            num_recent -= 1
+        while len(lines) and estimate_tokens(summary()) > budget:
+            lines.pop(0)
+        return summary() + [x for turn in recent for x in turn]
+
+    def request_messages(self, team: int) -> List[Dict[str, str]]:
+        """Chat messages to send to the backend to get the next hint of `team`
+
+        Messages are ordered from the most to the least stable, to maximize the
+        prefix shared with previous requests: the instruct, the rules and board
+        words, the earlier turns, and last the prompt for the current board.
+        """
+        prefix = [self.chat_history[team][0][1], self.rules]
+        prompt = {"role": "user", "content": self.prompt_for(team)}
+        if self.history_mode == "last":
+            return prefix + [prompt]
+        if self.history_mode == "budget":
+            budget = self.history_budget - estimate_tokens(prefix + [prompt])
+            return prefix + self.budgeted_history(team, budget) + [prompt]
+        history = [self.sent_message(*x) for x in self.chat_history[team][1:]]
+        return prefix + history + [prompt]
+
+    def request_key(self, messages: List[Dict[str, str]]) -> Tuple:
+        """Identifies a hint request: a prefetched hint can only be used for a
+        request with the same key"""
+        return (
+            self.model_name,
+            self.temperature,
+            tuple((x["role"], x["content"]) for x in messages),
+        )
+
+    def record_usage(
+        self,
+        messages: List[Dict[str, str]],
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+        estimated: bool = False,
+    ) -> None:
+        """Account the tokens of a request, estimating the prompt tokens when
+        the backend did not report them
+
+        :param cached_tokens: Prompt tokens served from the provider's cache
+        :param estimated: Whether the usage was estimated rather than reported,
+            e.g. for a stream closed early, so that the cached tokens are unknown
+        """
+        estimated = estimated or not prompt_tokens
+        prompt_tokens = prompt_tokens or estimate_tokens(messages)
+        self.token_usage["prompt_tokens"] += prompt_tokens
+        self.token_usage["cached_tokens"] += cached_tokens
+        self.token_usage["completion_tokens"] += completion_tokens
+        self.token_usage["last_prompt_tokens"] = prompt_tokens
+        self.token_usage["last_cached_tokens"] = cached_tokens
+        self.token_usage["estimated_requests"] += estimated
+        self.token_usage["last_estimated"] = estimated
+        if estimated:
+            METRICS.inc("usage_estimated_total", model=self.model_name)
+        METRICS.inc("tokens_total", prompt_tokens, model=self.model_name, kind="prompt")
+        METRICS.inc("tokens_total", cached_tokens, model=self.model_name, kind="cached")
+        METRICS.inc(
+            "tokens_total", completion_tokens, model=self.model_name, kind="completion"
+        )
+
+    def complete(self, messages: List[Dict[str, str]], n: int = 1) -> Completion:
+        """Query the backend with the given chat `messages`, sampling `n` answers"""
+        with METRICS.timer(
+            "api_request_seconds", backend=self.backend_name, mode="complete"
+        ):
+            completion = self.backend.complete(
+                model=self.model_name,
+                messages=messages,
+                temperature=self.temperature,
+                n=n,
+                response_format=self.response_format,
+            )
+        self.record_usage(
+            messages,
+            completion.prompt_tokens,
+            completion.completion_tokens,
+            completion.cached_tokens,
+        )
+        return completion
+
+    def parse(self, content: str) -> Tuple[str, int]:
+        """Parse a hint answered by the model, counting parse failures per model
+
+        :raises ValueError: if no hint is found
+        """
+        try:
+            hint = parse_hint(content)
+        except ValueError:
+            PARSE_STATS.record(self.model_name, False)
+            METRICS.inc("hint_parse_total", model=self.model_name, result="failure")
+            raise
+        PARSE_STATS.record(self.model_name, True)
+        METRICS.inc("hint_parse_total", model=self.model_name, result="success")
+        return hint
+
+    def pick_hint(
+        self, choices: List[str], board: BoardState
+    ) -> Optional[Tuple[str, int]]:
+        """Return the best valid hint among candidate answers, or None if none is
+        valid: the hint word proposed most often, then with the largest number"""
+        hints = []
+        for content in choices:
+            try:
+                hint_word, hint_num = self.parse(content)
+            except ValueError:
+                continue
+            if hint_num >= 1 and hint_word not in board:
+                hints.append((hint_word, hint_num))
+        if not len(hints):
+            return None
+        votes = {}
+        for hint_word, _ in hints:
+            votes[hint_word] = votes.get(hint_word, 0) + 1
+        return max(hints, key=lambda x: (votes[x[0]], x[1]))
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        on_partial: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Stream the completion of `messages` from the backend, and close the
+        stream as soon as it holds a complete hint
+
+        :param on_partial: Called with the text generated so far after each chunk
+        :return: The hint as `WORD - NUMBER`, or the whole text if none was found
+        """
+        text, hint, usage = "", None, None
+        with METRICS.timer(
+            "api_request_seconds", backend=self.backend_name, mode="stream"
+        ):
+            stream = self.backend.stream(
+                model=self.model_name,
+                messages=messages,
+                temperature=self.temperature,
+                response_format=self.response_format,
+            )
+            try:
+                for chunk in stream:
+                    if isinstance(chunk, Completion):
+                        usage = chunk
+                        continue
+                    text += chunk
+                    if on_partial is not None:
+                        on_partial(text)
+                    hint = parse_streamed_hint(text)
+                    if hint is not None:
+                        METRICS.inc("stream_early_stops_total", model=self.model_name)
+                        break
+            finally:
+                stream.close()
+        if usage is None:
+            # Streams closed early never get to their usage
+            self.record_usage(messages, 0, (len(text) + 3) // 4, estimated=True)
+        else:
+            self.record_usage(
+                messages,
+                usage.prompt_tokens,
+                usage.completion_tokens,
+                usage.cached_tokens,
+            )
+        return text if hint is None else f"{hint[0]} - {hint[1]}"
+
     def remove(self, word: str, team: int) -> None:
         """Action of guessing the given `word` which is assigned to the given `team`
 
@@ -172,41 +627,70 @@ class Spymaster:
         self.chat_history[self.current_team].append(
             (
                 MessageType.Guess,
-                {"role": "user", "content": f"Your teammate picked {word}"},
+                {"role": "user", "content": f"{GUESS_PREFIX}{word}"},
             ),
         )
-
-        # Guessed the killer card :(
-        if team == -1:
-            self.kll.remove(word)
-
-        # Guessed a neutral or opponent : end turn
-        elif team == 0 or team != (self.current_team + 1):
-            (self.ntr if team == 0 else self.words(1 - self.current_team)).remove(word)
-            self.end_turn()
+        self.board.remove(word)
 
         # Guessed a correct word: we only continue if we have left over guesses + 1
-        else:
+        if team == self.current_team + 1:
             self.current_hint_num -= 1
-            self.words(self.current_team).remove(word)
             if self.current_hint_num < 0:
                 self.end_turn()
 
+        # Guessed a neutral or opponent : end turn. Guessing the killer card
+        # ends the game instead :(
+        elif team != KILLER:
+            self.end_turn()
+        self.record((GUESS, word, 0))
+        self.prefetch()
+
     def end_turn(self) -> None:
         """End turn immediately"""
         self.current_hint_word = None
         self.current_team = 1 - self.current_team
-
-    def give_hint(self, num_retries: int = 2, debug: bool = False) -> None:
-        """Generates hint by prompting the language model
+        self.prefetch()
+
+    def pass_turn(self) -> None:
+        """Action of passing the turn without guessing any more word"""
+        if not self.prefetch_enabled:
+            self.cancel_hint(self.current_team)
+        self.end_turn()
+        self.record((PASS, None, 0))
+
+    def set_hint(self, hint_word: str, hint_num: int) -> None:
+        """Set the current hint and add it to the current team's history"""
+        self.current_hint_word = hint_word
+        self.current_hint_num = self.og_hint_num = hint_num
+        self.chat_history[self.current_team].append(
+            (
+                MessageType.Hint,
+                {"role": "assistant", "content": f"{hint_word} - {hint_num}"},
+            )
+        )
+        self.record((HINT, hint_word, hint_num))
+
+    def give_hint(
+        self,
+        num_retries: int = 2,
+        debug: bool = False,
+        on_partial: Optional[Callable[[str], None]] = None,
+        fallback: bool = True,
+    ) -> None:
+        """Generates hint by prompting the language model, or use the hint
+        prefetched for the current state if any
 
         :param num_retries: Number of retries in case the generated hint is
             badly formatted
         :param debug: If True, print more verbose output
+        :param on_partial: Called with the partial hint when streaming
+        :param fallback: If False, a hint generated in the background (see
+            `start_hint`) which failed is not generated again here, where it
+            would block the caller
         """
-        self.chat_history[self.current_team].append(
-            (MessageType.Prompt, {"role": "user", "content": self.prompt})
-        )
+        team = self.current_team
+        messages = self.request_messages(team)
+        self.chat_history[team].append((MessageType.Prompt, messages[-1]))
 
         if debug:
             print(
@@ -217,77 +701,297 @@ class Spymaster:
             )
 
         self.current_hint_num = -1
-        while self.current_hint_num < 1 and num_retries >= 0:
-            try:
-                # Prompt assistant
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[
-                        self.chat_history[self.current_team][0][1],
-                        self.chat_history[self.current_team][-1][1],
-                    ]
-                    if self.use_last_prompt_only
-                    else [x[1] for x in self.chat_history[self.current_team]],
-                    temperature=self.temperature,
+        with METRICS.timer("hint_seconds", backend=self.backend_name):
+            background = team in self._prefetched
+            hint = self.take_prefetched(team, messages)
+            if hint is None and (fallback or not background):
+                hint = self.generate_hint(
+                    messages, self.board_snapshot(), num_retries, on_partial
                 )
-                out = completion.choices[0].message.content.split("-")
-
-                # Parse response until we get a valid hint
-                hint_word, self.current_hint_num = out[0].strip().upper(), int(
-                    out[-1].strip().replace(".", "")
+        if hint is not None:
+            self.set_hint(*hint)
+        self.prefetch()
+
+    def generate_hint(
+        self,
+        messages: List[Dict[str, str]],
+        board: BoardState,
+        num_retries: int = 2,
+        on_partial: Optional[Callable[[str], None]] = None,
+    ) -> Optional[Tuple[str, int]]:
+        """Query the hint cache, or the backend until getting a valid hint
+
+        This does not modify the game state, hence can run in a background thread.
+
+        :param messages: Chat messages to send
+        :param board: Snapshot of the board, whose words left are not valid hints
+        :param num_retries: Number of retries in case the generated hint is
+            badly formatted, the request for several candidates counting as one
+        :param on_partial: Called with the partial hint when streaming
+        :return: The hint word and number, or None if all attempts failed
+        """
+        # Reuse the hint given to the exact same request, if any
+        cache_key = None
+        if self.hint_cache is not None and not self.hint_cache.bypass(self.temperature):
+            with METRICS.timer("phase_seconds", phase="cache_key"):
+                cache_key = self.hint_cache.key(
+                    self.backend_name, self.model_name, self.temperature, messages
+                )
+            cached = self.hint_cache.get(cache_key)
+            if cached is not None:
+                try:
+                    hint_word, hint_num = parse_hint(cached)
+                    if hint_num >= 1 and hint_word not in board:
+                        METRICS.inc("hint_cache_total", result="hit")
+                        return hint_word, hint_num
+                except ValueError:
+                    pass
+            METRICS.inc("hint_cache_total", result="miss")
+
+        # Share the request of another game sending the exact same one
+        if self.single_flight is not None and not self.single_flight.bypass(
+            self.temperature
+        ):
+            key = cache_key or HintCache.key(
+                self.backend_name, self.model_name, self.temperature, messages
+            )
+            shared_partial = on_partial
+            if on_partial is not None:
+                # Keep the request going while other games wait for it
+                def shared_partial(text: str) -> None:
+                    try:
+                        on_partial(text)
+                    except RequestCancelled:
+                        if not self.single_flight.followers(key):
+                            raise
+
+            return self.single_flight.do(
+                key,
+                lambda: self.request_hint(
+                    messages, board, num_retries, shared_partial, cache_key
+                ),
+            )
+        return self.request_hint(messages, board, num_retries, on_partial, cache_key)
+
+    def request_hint(
+        self,
+        messages: List[Dict[str, str]],
+        board: BoardState,
+        num_retries: int = 2,
+        on_partial: Optional[Callable[[str], None]] = None,
+        cache_key: Optional[str] = None,
+    ) -> Optional[Tuple[str, int]]:
+        """Query the backend until getting a valid hint, see `generate_hint`
+
+        :param cache_key: Key under which to cache the hint, if any
+        """
+        # Sample several candidates at once, so that a single round trip is
+        # usually enough even when some answers are invalid
+        if self.num_candidates > 1:
+            self.num_requests += 1
+            num_retries -= 1
+            try:
+                hint = self.pick_hint(
+                    self.complete(messages, n=self.num_candidates).choices, board
                 )
+            except BackendError:
+                hint = None
+            if hint is not None:
+                if cache_key is not None:
+                    self.hint_cache.put(cache_key, f"{hint[0]} - {hint[1]}")
+                return hint
+            METRICS.inc("hint_candidates_fallbacks_total", backend=self.backend_name)
+            METRICS.inc("hint_retries_total", backend=self.backend_name)
+
+        while num_retries >= 0:
+            try:
+                # Prompt assistant
+                self.num_requests += 1
+                if self.streaming:
+                    content = self.stream(messages, on_partial)
+                else:
+                    content = self.complete(messages).content
+                hint_word, hint_num = self.parse(content)
                 # Need to give at least one number and not give a word on the board
-                if (
-                    self.current_hint_num >= 1
-                    and not (
-                        hint_word in self.slf
-                        or hint_word in self.opp
-                        or hint_word in self.ntr
-                        or hint_word in self.kll
-                    )
-                    # if num retries hits 0, we still give a hint even though it might be invalid
-                ) or num_retries == 0:
-                    self.current_hint_word = hint_word
-                    self.og_hint_num = self.current_hint_num
-                    self.chat_history[self.current_team].append(
-                        (
-                            MessageType.Hint,
-                            {
-                                "role": "assistant",
-                                "content": f"{self.current_hint_word} - {self.current_hint_num}",
-                            },
-                        )
-                    )
-                    break
-            except ValueError:
+                valid = hint_num >= 1 and hint_word not in board
+                # if num retries hits 0, we still give a hint even though it might be invalid
+                if valid or num_retries == 0:
+                    if valid and cache_key is not None:
+                        self.hint_cache.put(cache_key, f"{hint_word} - {hint_num}")
+                    return hint_word, hint_num
+            except (ValueError, BackendError):
                 pass
             num_retries -= 1
+            if num_retries >= 0:
+                METRICS.inc("hint_retries_total", backend=self.backend_name)
+        return None
+
+    def use_prefetch(self, enabled: bool) -> None:
+        """Whether to generate the next hints in the background"""
+        self.prefetch_enabled = enabled and self.is_remote
+        if not self.prefetch_enabled:
+            # The current team's hint is needed anyway
+            self.cancel_hint(1 - self.current_team)
+
+    def submit_hint(
+        self,
+        team: int,
+        messages: List[Dict[str, str]],
+        executor: ThreadPoolExecutor = PREFETCH_EXECUTOR,
+    ) -> None:
+        """Generate in the background the hint of `team` for `messages`, taken
+        later by `give_hint`"""
+        cancelled = threading.Event()
+
+        def on_partial(text: str) -> None:
+            if cancelled.is_set():
+                raise HintCancelled()
+            self.partial_hints[team] = text
+
+        self.partial_hints.pop(team, None)
+        self._prefetched[team] = (
+            self.request_key(messages),
+            executor.submit(
+                self.generate_hint, messages, self.board_snapshot(), 2, on_partial
+            ),
+            cancelled,
+        )
+
+    def cancel_hint(self, team: Optional[int] = None) -> None:
+        """Cancel the hint generated in the background for `team`, or for both
+        teams. A streamed hint stops at its next chunk; the answer of any other
+        request in flight is discarded."""
+        for t in list(self._prefetched) if team is None else [team]:
+            if t in self._prefetched:
+                _, future, cancelled = self._prefetched.pop(t)
+                future.cancel()
+                cancelled.set()
+            self.partial_hints.pop(t, None)
+
+    def start_hint(self) -> None:
+        """Start generating the current team's hint in the background, unless
+        it is given or already being generated; `give_hint` takes it without
+        waiting once `hint_ready`"""
+        if (
+            not self.is_remote
+            or self.current_hint_word is not None
+            or self.winner is not None
+        ):
+            return
+        team = self.current_team
+        messages = self.request_messages(team)
+        if team in self._prefetched:
+            if self._prefetched[team][0] == self.request_key(messages):
+                return
+            self.cancel_hint(team)
+        self.submit_hint(team, messages, HINT_EXECUTOR)
+
+    def hint_ready(self) -> bool:
+        """Whether `give_hint` would return at once, not waiting for a hint
+        generated in the background"""
+        entry = self._prefetched.get(self.current_team)
+        return entry is None or entry[1].done()
+
+    def hint_failed(self) -> bool:
+        """Whether the hint generated in the background for the current team
+        failed: every attempt was invalid, or it raised"""
+        entry = self._prefetched.get(self.current_team)
+        if entry is None or not entry[1].done() or entry[1].cancelled():
+            return False
+        return entry[1].exception() is not None or entry[1].result() is None
+
+    def retry_hint(self) -> None:
+        """Generate again in the background the current team's hint"""
+        self.cancel_hint(self.current_team)
+        self.start_hint()
+
+    def prefetch(self) -> None:
+        """Start generating in the background the hints needed next: the current
+        team's if it has none yet, and the other team's for when the turn ends
+
+        Prefetched hints are bound to the request they were generated for, so
+        the ones outdated by a guess are cancelled (or discarded once done).
+        """
+        if not self.prefetch_enabled or self.winner is not None:
+            return
+        for team in (self.current_team, 1 - self.current_team):
+            if team == self.current_team and self.current_hint_word is not None:
+                continue
+            messages = self.request_messages(team)
+            key = self.request_key(messages)
+            if team in self._prefetched:
+                if self._prefetched[team][0] == key:
+                    continue
+                self.cancel_hint(team)
+                METRICS.inc("hint_prefetch_total", result="stale")
+            self.submit_hint(team, messages)
+
+    def take_prefetched(
+        self, team: int, messages: List[Dict[str, str]]
+    ) -> Optional[Tuple[str, int]]:
+        """Return the hint prefetched for this exact request, waiting for it to
+        be generated if needed, or None if there is none"""
+        if team not in self._prefetched:
+            return None
+        if self._prefetched[team][0] != self.request_key(messages):
+            self.cancel_hint(team)
+            METRICS.inc("hint_prefetch_total", result="stale")
+            return None
+        _, future, _ = self._prefetched.pop(team)
+        self.partial_hints.pop(team, None)
+        try:
+            hint = future.result()
+        except Exception:
+            return None
+        if hint is not None:
+            METRICS.inc("hint_prefetch_total", result="hit")
+        return hint
 
-    def play(self) -> Tuple[str, int]:
-        """Display action in the hint box based on the current game's state"""
+    @property
+    def winner(self) -> Optional[int]:
+        """Team who won the game, or None if the game is still going"""
+        if self.board.found(KILLER):
+            return 1 - self.current_team
+        for team in (0, 1):
+            if self.board.count(team + 1) == 0:
+                return team
+        return None
+
+    def play(
+        self,
+        on_partial: Optional[Callable[[str], None]] = None,
+        fallback: bool = True,
+    ) -> Tuple[str, int]:
+        """Display action in the hint box based on the current game's state
+
+        :param on_partial: Called with the partial hint when streaming
+        :param fallback: See `give_hint`
+        """
         fmt = ":blue[{}]" if self.current_team == 1 else ":red[{}]"
 
-        # Check if we lost by guessing the killer card in the previous action
-        if len(self.kll) == 0:
+        # Check if we lost by guessing a killer card in the previous action
+        if self.board.found(KILLER):
             return (
                 fmt.format("You found the assasin. You lost ☠️"),
                 -1,
             )
 
         # Check if we lost by guessing the opponent's last word
-        if len(self.words(1 - self.current_team)) == 0:
+        if self.board.count(2 - self.current_team) == 0:
             return (
                 fmt.format("You guessed for the other team.You lost ☠️"),
                 -1,
             )
 
         # Check if we won
-        if len(self.words(self.current_team)) == 0:
+        if self.board.count(self.current_team + 1) == 0:
             return fmt.format("You guessed all your cards. You win 🪩 !"), 1
 
         # Otherwise, give a hint and continue
         if self.current_hint_word is None:
-            self.give_hint()
+            self.give_hint(on_partial=on_partial, fallback=fallback)
+        if self.current_hint_word is None:
+            return fmt.format("The spymaster could not give a hint"), 0
 
         return (
             fmt.format(f"{self.current_hint_word} - {self.og_hint_num}")
@@ -297,11 +1001,13 @@ class Spymaster:
         )
 
 
-@st.cache_resource
 def init_spymaster(
-    _client: OpenAI, model_name: str, words: List[str], team_assignment: List[int]
+    backend: SpymasterBackend,
+    model_name: str,
+    words: List[str],
+    team_assignment: List[int],
+    lang: str = "en",
 ) -> Spymaster:
-    """Init the spymaster object"""
-    spymaster = Spymaster(_client, model_name)
-    spymaster.update_words(words, team_assignment)
-    return spymaster
+    """Init the spymaster object, built by the backend for a board in language
+    `lang`"""
+    return backend.init_spymaster(model_name, words, team_assignment, lang)
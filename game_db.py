@@ -0,0 +1,186 @@
+"""Durable storage of the games in progress, so that they survive server restarts
+and reconnections
+
+A game is stored as its board (words and card types), the settings it was
+started with, and the log of its moves, appended as they are played: hints
+given, words guessed and turns passed. Replaying the moves on a new spymaster
+restores the game, chat history included.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from telemetry import METRICS
+
+DEFAULT_GAME_DB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "games.sqlite3"
+)
+
+# Kinds of moves
+HINT, GUESS, PASS = "H", "G", "P"
+
+# A move: its kind, and the word and number of a hint or the word guessed
+Move = Tuple[str, Optional[str], int]
+
+
+@dataclass
+class SavedGame:
+    """A game as stored in the database
+
+    :param words: Words on the board
+    :param team_assignment: Card type of every word
+    :param settings: Settings the game was started with
+    :param remaining: Bitmask of the words still to guess, see `BoardState`
+    :param current_team: Team playing, 0 or 1
+    :param moves: Moves played so far, in order
+    """
+
+    words: List[str]
+    team_assignment: List[int]
+    settings: Dict[str, Any]
+    remaining: int
+    current_team: int
+    moves: List[Move]
+
+
+class GameDB:
+    """Games stored in SQLite, with one row per game and one per move
+
+    Every move is a single insert and update, committed at once; the database
+    is in WAL mode so that these writes are cheap and do not block readers.
+
+    :param path: SQLite database file, or ":memory:"
+    :param ttl: Games not played for `ttl` seconds are deleted
+    """
+
+    def __init__(
+        self, path: str = DEFAULT_GAME_DB_PATH, ttl: float = 7 * 24 * 3600
+    ) -> None:
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS games (id TEXT PRIMARY KEY, words TEXT,"
+            " cards BLOB, settings TEXT, remaining BLOB, team INTEGER,"
+            " num_moves INTEGER, updated REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS moves (game TEXT, seq INTEGER, kind TEXT,"
+            " word TEXT, num INTEGER, PRIMARY KEY (game, seq)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self.purge()
+
+    def create(
+        self,
+        game_id: str,
+        words: Sequence[str],
+        team_assignment: Sequence[int],
+        settings: Dict[str, Any],
+        current_team: int = 1,
+    ) -> None:
+        """Store a new game, replacing any game with the same id"""
+        with self._lock:
+            self._conn.execute("DELETE FROM moves WHERE game = ?", (game_id,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                (
+                    game_id,
+                    "\n".join(words),
+                    array("b", team_assignment).tobytes(),
+                    json.dumps(settings, separators=(",", ":")),
+                    ((1 << len(words)) - 1).to_bytes(8, "little"),
+                    current_team,
+                    time.time(),
+                ),
+            )
+            self._conn.commit()
+
+    def record(
+        self,
+        game_id: str,
+        move: Move,
+        remaining: int,
+        current_team: int,
+    ) -> None:
+        """Append a move to a game, with the board and team after the move"""
+        with METRICS.timer("phase_seconds", phase="save_move"), self._lock:
+            row = self._conn.execute(
+                "SELECT num_moves FROM games WHERE id = ?", (game_id,)
+            ).fetchone()
+            if row is None:
+                return
+            self._conn.execute(
+                "INSERT INTO moves VALUES (?, ?, ?, ?, ?)", (game_id, row[0], *move)
+            )
+            self._conn.execute(
+                "UPDATE games SET remaining = ?, team = ?, num_moves = ?, updated = ?"
+                " WHERE id = ?",
+                (
+                    remaining.to_bytes(8, "little"),
+                    current_team,
+                    row[0] + 1,
+                    time.time(),
+                    game_id,
+                ),
+            )
+            self._conn.commit()
+
+    def load(self, game_id: str) -> Optional[SavedGame]:
+        """Return the stored game with the given id, if any"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT words, cards, settings, remaining, team FROM games"
+                " WHERE id = ?",
+                (game_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            moves = self._conn.execute(
+                "SELECT kind, word, num FROM moves WHERE game = ? ORDER BY seq",
+                (game_id,),
+            ).fetchall()
+        words, cards, settings, remaining, team = row
+        return SavedGame(
+            words=words.split("\n"),
+            team_assignment=array("b", cards).tolist(),
+            settings=json.loads(settings),
+            remaining=int.from_bytes(remaining, "little"),
+            current_team=team,
+            moves=moves,
+        )
+
+    def delete(self, game_id: str) -> None:
+        """Remove a game and its moves"""
+        with self._lock:
+            self._conn.execute("DELETE FROM moves WHERE game = ?", (game_id,))
+            self._conn.execute("DELETE FROM games WHERE id = ?", (game_id,))
+            self._conn.commit()
+
+    def purge(self) -> int:
+        """Delete the games not played for `ttl` seconds, return their number"""
+        with self._lock:
+            expired = time.time() - self.ttl
+            self._conn.execute(
+                "DELETE FROM moves WHERE game IN (SELECT id FROM games"
+                " WHERE updated < ?)",
+                (expired,),
+            )
+            num_deleted = self._conn.execute(
+                "DELETE FROM games WHERE updated < ?", (expired,)
+            ).rowcount
+            self._conn.commit()
+        return num_deleted
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM games").fetchone()[0]
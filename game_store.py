@@ -0,0 +1,142 @@
+"""Registry of the games in progress in a server process"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from engine import Spymaster
+from telemetry import METRICS
+
+# Rough memory footprint of a game besides its chat history, in bytes
+BASE_GAME_SIZE = 16 * 1024
+
+
+def game_size(spymaster: Spymaster) -> int:
+    """Rough memory footprint of a game, in bytes"""
+    return BASE_GAME_SIZE + sum(
+        len(message["content"])
+        for history in spymaster.chat_history
+        for _, message in history
+    )
+
+
+class GameStore:
+    """Games of all sessions, each under its own id, evicted when idle for too
+    long or, least recently used first, when there are too many of them
+
+    :param max_games: Maximum number of live games
+    :param idle_ttl: Games not accessed for `idle_ttl` seconds are evicted
+    :param max_memory: Maximum estimated memory of all live games, in bytes
+    """
+
+    def __init__(
+        self,
+        max_games: int = 1000,
+        idle_ttl: float = 2 * 3600,
+        max_memory: int = 256 * 1024**2,
+    ) -> None:
+        self.max_games = max_games
+        self.idle_ttl = idle_ttl
+        self.max_memory = max_memory
+        self._lock = threading.Lock()
+        # Game id -> (spymaster, last access time, size), least recent first
+        self._games = OrderedDict()
+        # Game id -> (lock, number of callers), so that a game is only created
+        # once when several sessions resume it at the same time
+        self._game_locks: Dict[str, list] = {}
+        self._memory = 0
+        self.created = 0
+        self.evicted = {"idle": 0, "count": 0, "memory": 0}
+
+    def get_or_create(
+        self, game_id: str, factory: Callable[[], Spymaster]
+    ) -> Spymaster:
+        """Return the game with the given id, creating it with `factory` if it
+        does not exist or was evicted"""
+        with self._lock:
+            game_lock = self._game_locks.setdefault(game_id, [threading.Lock(), 0])
+            game_lock[1] += 1
+        try:
+            # Only the callers with the same id wait for `factory`
+            with game_lock[0]:
+                return self._get_or_create(game_id, factory)
+        finally:
+            with self._lock:
+                game_lock[1] -= 1
+                if not game_lock[1]:
+                    del self._game_locks[game_id]
+
+    def _get_or_create(
+        self, game_id: str, factory: Callable[[], Spymaster]
+    ) -> Spymaster:
+        now = time.monotonic()
+        with self._lock:
+            if game_id in self._games:
+                spymaster, _, size = self._games.pop(game_id)
+                self._memory -= size
+            else:
+                spymaster = None
+        created = spymaster is None
+        METRICS.inc("game_store_total", result="miss" if created else "hit")
+        if created:
+            spymaster = factory()
+        with self._lock:
+            self.created += created
+            size = game_size(spymaster)
+            self._games[game_id] = (spymaster, now, size)
+            self._memory += size
+            self._evict(now)
+        return spymaster
+
+    def discard(self, game_id: str) -> None:
+        """Remove a game, e.g. when it is restarted"""
+        with self._lock:
+            if game_id in self._games:
+                self._release(game_id)
+
+    def _release(self, game_id: str) -> None:
+        spymaster, _, size = self._games.pop(game_id)
+        self._memory -= size
+        # Cancel the hints still being prefetched for this game
+        spymaster.cancel_hint()
+
+    def _evict(self, now: float) -> None:
+        """Evict idle games, then least recently used games above the limits.
+        The game accessed last is never evicted."""
+        while len(self._games) > 1:
+            game_id, (_, accessed, _) = next(iter(self._games.items()))
+            if now - accessed > self.idle_ttl:
+                reason = "idle"
+            elif len(self._games) > self.max_games:
+                reason = "count"
+            elif self._memory > self.max_memory:
+                reason = "memory"
+            else:
+                break
+            self._release(game_id)
+            self.evicted[reason] += 1
+            METRICS.inc("game_store_evicted_total", reason=reason)
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self._games
+
+    def get(self, game_id: str) -> Optional[Spymaster]:
+        """Return the game with the given id if it is live, without touching it"""
+        entry = self._games.get(game_id)
+        return entry[0] if entry is not None else None
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Live, created and evicted games, and estimated memory"""
+        return {
+            "live": len(self._games),
+            "created": self.created,
+            "evicted_idle": self.evicted["idle"],
+            "evicted_count": self.evicted["count"],
+            "evicted_memory": self.evicted["memory"],
+            "memory": self._memory,
+        }
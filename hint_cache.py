@@ -0,0 +1,214 @@
+"""Persistent cache of hints, shared by all games, so that repeated boards (fixed
+seeds, restarts) get their hint instantly and without any API call, and
+coalescing of the identical requests sent by several games at the same time"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, TypeVar
+
+from telemetry import METRICS
+
+T = TypeVar("T")
+
+DEFAULT_HINT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "hints.sqlite3"
+)
+
+
+class HintCache:
+    """Size-bounded hint cache stored in SQLite, with LRU and TTL eviction
+
+    :param path: SQLite database file, or ":memory:"
+    :param max_entries: Least recently used entries are evicted above this size
+    :param ttl: Entries older than `ttl` seconds are discarded
+    :param creative_temperature: Requests sampled at or above this temperature
+        bypass the cache, so that creative play still gets fresh hints
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_HINT_CACHE_PATH,
+        max_entries: int = 100000,
+        ttl: float = 30 * 24 * 3600,
+        creative_temperature: float = 1.2,
+    ) -> None:
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.creative_temperature = creative_temperature
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hints (key TEXT PRIMARY KEY, hint TEXT,"
+            " created REAL, accessed REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS hints_accessed ON hints (accessed)"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM hints").fetchone()[0]
+
+    @staticmethod
+    def key(
+        backend: str, model: str, temperature: float, messages: List[Dict[str, str]]
+    ) -> str:
+        """Key of a hint request
+
+        `messages` hold the system instruct, the formatted prompt and, when the
+        whole history is used, all previous turns. Temperatures are bucketed to
+        one decimal.
+        """
+        return hashlib.blake2b(
+            json.dumps(
+                [backend, model, round(temperature, 1), messages],
+                separators=(",", ":"),
+            ).encode(),
+            digest_size=16,
+        ).hexdigest()
+
+    def bypass(self, temperature: float) -> bool:
+        """Whether requests at this temperature should skip the cache"""
+        return temperature >= self.creative_temperature
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached hint for `key`, if any and not expired"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hint, created FROM hints WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM hints WHERE key = ?", (key,))
+                    self._size -= 1
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE hints SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, hint: str) -> None:
+        """Store a hint, evicting expired then least recently used entries"""
+        now = time.time()
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM hints WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hints VALUES (?, ?, ?, ?)",
+                (key, hint, now, now),
+            )
+            self._size += exists is None
+            if self._size > self.max_entries:
+                # Evict in batches to amortize the cost of eviction
+                num_evicted = self._conn.execute(
+                    "DELETE FROM hints WHERE created < ?", (now - self.ttl,)
+                ).rowcount
+                num_evicted += self._conn.execute(
+                    "DELETE FROM hints WHERE key IN (SELECT key FROM hints"
+                    " ORDER BY accessed LIMIT ?)",
+                    (max(0, self._size - num_evicted - self.max_entries * 9 // 10),),
+                ).rowcount
+                self._size -= num_evicted
+                self.evictions += num_evicted
+            self._conn.commit()
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        with self._lock:
+            self._conn.execute("DELETE FROM hints")
+            self._conn.commit()
+            self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Hit, miss and eviction counters, and current size"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self._size,
+        }
+
+
+class RequestCancelled(Exception):
+    """Raised by a request no longer needed by the caller running it; the
+    callers which shared it send it again themselves"""
+
+
+class SingleFlight:
+    """Coalescing of identical requests in flight: the first caller with a given
+    key runs the request, and the callers arriving with the same key before it
+    completes wait for its result instead of sending their own
+
+    :param creative_temperature: Requests sampled at or above this temperature
+        are never coalesced, so that every game gets its own hint
+    """
+
+    def __init__(self, creative_temperature: float = 1.2) -> None:
+        self.creative_temperature = creative_temperature
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._followers: Dict[str, int] = {}
+
+    def bypass(self, temperature: float) -> bool:
+        """Whether requests at this temperature should not be coalesced"""
+        return temperature >= self.creative_temperature
+
+    def followers(self, key: str) -> int:
+        """Number of callers waiting for the request in flight with `key`"""
+        with self._lock:
+            return self._followers.get(key, 0)
+
+    def do(self, key: str, request: Callable[[], T]) -> T:
+        """Run `request`, or wait for the result of the one in flight with the
+        same `key`. Exceptions are raised to all the callers, except
+        `RequestCancelled`: the callers waiting then run the request again."""
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = self._in_flight[key] = Future()
+                    break
+                self.shared += 1
+                self._followers[key] = self._followers.get(key, 0) + 1
+            METRICS.inc("hint_coalesced_total")
+            try:
+                return future.result()
+            except RequestCancelled:
+                pass
+            finally:
+                with self._lock:
+                    self._followers[key] -= 1
+                    if not self._followers[key]:
+                        del self._followers[key]
+        try:
+            result = request()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
@@ -0,0 +1,125 @@
+"""Parsing of the hints answered by the spymaster's language model
+
+Hints are asked as `WORD - NUMBER`, or as a JSON object `{"word": ..., "number": ...}`
+when the backend supports structured output (see `HINT_RESPONSE_FORMAT`). Free text
+answers are parsed leniently: markdown, quotes, a leading "Hint:" label, hyphenated
+words, other dashes or separators, and explanations around the hint are accepted.
+"""
+
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+HINT_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "word": {"type": "string"},
+        "number": {"type": "integer"},
+    },
+    "required": ["word", "number"],
+    "additionalProperties": False,
+}
+
+# `response_format` of the OpenAI chat completions API constraining answers to
+# a single JSON hint
+HINT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "codenames_hint",
+        "strict": True,
+        "schema": HINT_JSON_SCHEMA,
+    },
+}
+
+_JSON_HINT_REGEX = re.compile(
+    r'"word"\s*:\s*"(?P<word>[^"\\]*)"\s*,\s*"number"\s*:\s*(?P<num>\d+)'
+)
+_JSON_HINT_REVERSED_REGEX = re.compile(
+    r'"number"\s*:\s*(?P<num>\d+)\s*,\s*"word"\s*:\s*"(?P<word>[^"\\]*)"'
+)
+# Markdown and quotes, then an optional "Hint:" label, before the word
+_PREFIX = r"""[*_`"'>#\s]*(?:(?:hint|clue)\s*:?[*_`"'\s]*)?"""
+# Possibly hyphenated word, then markdown and quotes
+_WORD = r"""(?P<word>[^\W\d_][\w']*(?:-[^\W\d_][\w']*)*)[*_`"']*\s*"""
+# `WORD - NUMBER` or `WORD (NUMBER)` anywhere in the text
+_TEXT_HINT_REGEX = re.compile(
+    r"(?:^|(?<=\s))" + _PREFIX + _WORD + r"(?:[-–—=]\s*\(?|\()\s*(?P<num>\d+)",
+    re.IGNORECASE,
+)
+# `WORD: NUMBER` or `WORD, NUMBER`, which are common in prose, only at the start
+# of a line or after a label
+_LABELLED_HINT_REGEX = re.compile(
+    r"""(?:^[*_`"'>#\s]*|(?<![\w-])(?:hint|clue)\s*:?[*_`"'\s]*)"""
+    r"(?!(?:hint|clue)\b)" + _WORD + r"[:,]\s*\(?\s*(?P<num>\d+)",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def match_hint(content: str) -> Optional[re.Match]:
+    """Return the match of the first hint in `content`, with `word` and `num`
+    groups, or None if there is none"""
+    if "{" in content:
+        match = _JSON_HINT_REGEX.search(content) or _JSON_HINT_REVERSED_REGEX.search(
+            content
+        )
+        if match is not None:
+            return match
+    matches = [
+        match
+        for match in (
+            _TEXT_HINT_REGEX.search(content),
+            _LABELLED_HINT_REGEX.search(content),
+        )
+        if match is not None
+    ]
+    return min(matches, key=lambda x: x.start(), default=None)
+
+
+def parse_hint(content: str) -> Tuple[str, int]:
+    """Parse a hint in the format `WORD - NUMBER`, or a JSON hint
+
+    :raises ValueError: if no hint is found
+    """
+    match = match_hint(content)
+    if match is None:
+        raise ValueError(f"No hint found in {content!r}")
+    return match["word"].strip().upper(), int(match["num"])
+
+
+def parse_streamed_hint(text: str) -> Optional[Tuple[str, int]]:
+    """Parse the hint at the start of a text being streamed, once it is complete,
+    i.e. once its number is followed by something else than a digit"""
+    match = match_hint(text)
+    if match is None or match.end() == len(text):
+        return None
+    return match["word"].strip().upper(), int(match["num"])
+
+
+class ParseStats:
+    """Thread-safe counts of parsed and unparseable answers, per model"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, model: str, parsed: bool) -> None:
+        """Count an answer of `model`"""
+        with self._lock:
+            counts = self._counts.setdefault(model, [0, 0])
+            counts[not parsed] += 1
+
+    def failures(self, model: str) -> int:
+        """Number of answers of `model` which could not be parsed"""
+        return self._counts.get(model, [0, 0])[1]
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        """Parsed and failed counts of every model"""
+        with self._lock:
+            return {
+                model: {"parsed": parsed, "failed": failed}
+                for model, (parsed, failed) in self._counts.items()
+            }
+
+
+# Counters shared by all games of the process
+PARSE_STATS = ParseStats()
@@ -0,0 +1,193 @@
+"""Local OpenAI-compatible HTTP server answering with the deterministic `MockBackend`
+
+Useful to benchmark hint throughput, retries and UI latency without network or
+API costs. Select the "OpenAI-compatible endpoint" backend in the app with the
+printed base URL.
+
+Example:
+    python mock_server.py --port 8000 --latency 0.5 --jitter 0.2 --error-rate 0.1
+    python mock_server.py --port 8000 --token-latency 0.02 --chatty-rate 0.5
+"""
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backends import MockBackend
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """Serves `/v1/models` and `/v1/chat/completions`"""
+
+    backend = MockBackend()
+    error_status = 503
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [
+                        {"id": x, "object": "model", "created": 0, "owned_by": "mock"}
+                        for x in self.backend.list_models()
+                    ],
+                },
+            )
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self) -> None:
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        choices, error = self.backend.generate(
+            request["messages"],
+            int(request.get("n") or 1),
+            request.get("response_format") is not None,
+        )
+        prompt_tokens, cached_tokens = self.backend.prompt_usage(request["messages"])
+        delay = self.backend.first_token_delay(prompt_tokens - cached_tokens)
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            self._send_json(
+                self.error_status,
+                {"error": {"message": "Injected mock server error", "type": "mock"}},
+            )
+            return
+        if request.get("stream", False):
+            self._stream(request, choices[0])
+            return
+        if self.backend.token_latency > 0:
+            time.sleep(
+                self.backend.token_latency
+                * max(len(self.backend.tokens(x)) for x in choices)
+            )
+        completion_tokens = sum(len(x) // 4 for x in choices)
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", MockBackend.models[0]),
+                "choices": [
+                    {
+                        "index": i,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                    for i, content in enumerate(choices)
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                },
+            },
+        )
+
+    def _stream(self, request: dict, content: str) -> None:
+        """Answer with server-sent events, one chunk per token"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", MockBackend.models[0]),
+            "choices": [{"index": 0, "delta": {}, "finish_reason": None}],
+        }
+        try:
+            for token in self.backend.tokens(content):
+                if self.backend.token_latency > 0:
+                    time.sleep(self.backend.token_latency)
+                chunk["choices"][0]["delta"] = {"content": token}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            chunk["choices"][0].update(delta={}, finish_reason="stop")
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if (request.get("stream_options") or {}).get("include_usage"):
+                prompt_tokens, cached_tokens = self.backend.prompt_usage(
+                    request["messages"]
+                )
+                chunk.update(
+                    choices=[],
+                    usage={
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(content) // 4,
+                        "total_tokens": prompt_tokens + len(content) // 4,
+                        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                    },
+                )
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            pass
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def make_server(
+    host: str = "127.0.0.1", port: int = 8000, **backend_kwargs
+) -> ThreadingHTTPServer:
+    """Create (without starting) a mock server; `backend_kwargs` are passed
+    to `MockBackend`"""
+    handler = type(
+        "Handler", (MockRequestHandler,), {"backend": MockBackend(**backend_kwargs)}
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--prefill-latency", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--decorated-rate", type=float, default=0.0)
+    parser.add_argument("--chatty-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = make_server(
+        args.host,
+        args.port,
+        latency=args.latency,
+        prefill_latency=args.prefill_latency,
+        token_latency=args.token_latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        decorated_rate=args.decorated_rate,
+        chatty_rate=args.chatty_rate,
+        random_seed=args.seed,
+    )
+    print(f"Mock spymaster API listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,22 +3,52 @@ import sys
 import streamlit as st
 
 sys.path.append("..")
+from cached_engine import (
+    get_default_words_list,
+    get_game_store,
+    get_hint_cache,
+    get_lang_options,
+    get_single_flight,
+    get_word_pool,
+)
 from engine import (
+    DEFAULT_HISTORY_BUDGET,
+    DEFAULT_HISTORY_TURNS,
+    DEFAULT_SIDE_LENGTH,
     DEFAULT_SPYMASTER_INSTRUCT,
     DEFAULT_SPYMASTER_PROMPT,
     DEFAULT_SPYMASTER_TEMPERATURE,
-    get_default_words_list,
-    get_lang_options,
+    HISTORY_MODES,
+    SIDE_LENGTHS,
+)
+from hint_parser import PARSE_STATS
+from persistent_state import (
+    BOARD_LANG_KEY,
+    BOARD_POOL_KEY,
+    BOARD_SIZE_KEY,
+    BOARD_WORDS_KEY,
+    PERSISTENCE,
 )
-from persistent_state import BOARD_LANG_KEY, BOARD_WORDS_KEY
 from persistent_state import SETTINGS_PAGE_NAME as __PAGE_NAME__
 from persistent_state import (
     SPYMASTER_BEHAVIOR_KEY,
+    SPYMASTER_CACHE_KEY,
+    SPYMASTER_CANDIDATES_KEY,
+    SPYMASTER_COALESCE_KEY,
+    SPYMASTER_HISTORY_BUDGET_KEY,
+    SPYMASTER_HISTORY_TURNS_KEY,
     SPYMASTER_INSTRUCT_KEY,
+    SPYMASTER_PREFETCH_KEY,
     SPYMASTER_PROMPT_KEY,
+    SPYMASTER_STREAM_KEY,
+    SPYMASTER_STRUCTURED_KEY,
     SPYMASTER_TEMP_KEY,
-    persist_session_state,
+    SPYMASTER_USAGE_KEY,
 )
+from telemetry import METRICS
+from word_pool import WordPool
+
+PERSISTENCE.restore(__PAGE_NAME__)
 
 # Configure OpenAI Assistant for the spymaster role
 st.subheader("Spymaster parameters")
@@ -28,11 +58,108 @@ st.markdown(
 
 col1, col2 = st.columns(2)
 with col1:
+    history_mode = st.radio(
+        label="History sent with each request",
+        options=list(HISTORY_MODES),
+        format_func=HISTORY_MODES.get,
+        key=SPYMASTER_BEHAVIOR_KEY,
+    )
+    if history_mode == "budget":
+        st.number_input(
+            "Token budget per request",
+            min_value=100,
+            step=100,
+            value=st.session_state.get(
+                SPYMASTER_HISTORY_BUDGET_KEY, DEFAULT_HISTORY_BUDGET
+            ),
+            key=SPYMASTER_HISTORY_BUDGET_KEY,
+        )
+        st.number_input(
+            "Last turns kept verbatim",
+            min_value=0,
+            value=st.session_state.get(
+                SPYMASTER_HISTORY_TURNS_KEY, DEFAULT_HISTORY_TURNS
+            ),
+            key=SPYMASTER_HISTORY_TURNS_KEY,
+            help="Older turns are summarized as their hint and the outcome of "
+            "each pick",
+        )
+    if SPYMASTER_USAGE_KEY in st.session_state:
+        usage = st.session_state[SPYMASTER_USAGE_KEY]
+        st.caption(
+            "Current game: {last_prompt_tokens} prompt tokens ({last_cached}) in "
+            "the last request, {prompt_tokens} prompt ({cached_tokens} cached) and "
+            "{completion_tokens} completion tokens over {requests} requests, "
+            "{estimated_requests} of which estimated".format(
+                last_cached=(
+                    "estimated, cache unknown"
+                    if usage["last_estimated"]
+                    else f"{usage['last_cached_tokens']} cached"
+                ),
+                **usage,
+            )
+        )
+    game_stats = get_game_store().stats
+    st.caption(
+        "Server: {live} live games (about {mb:.1f} MB), {evicted_idle} evicted "
+        "when idle and {evicted} when over capacity".format(
+            mb=game_stats["memory"] / 1024**2,
+            evicted=game_stats["evicted_count"] + game_stats["evicted_memory"],
+            **game_stats,
+        )
+    )
     st.checkbox(
-        label="Use the whole history when prompting",
+        label="Stream hints",
         value=True,
-        key=SPYMASTER_BEHAVIOR_KEY,
+        key=SPYMASTER_STREAM_KEY,
+        help="Show hints as they are generated, and stop generation as soon as "
+        "the hint is complete, even if the model wanted to explain it",
+    )
+    st.checkbox(
+        label="Prefetch hints in the background",
+        value=False,
+        key=SPYMASTER_PREFETCH_KEY,
+        help="Hints are generated ahead of time, for the first turn and for the "
+        "other team while you are guessing. Each guess outdates the other team's "
+        "prefetched hint, so this costs extra API calls.",
+    )
+    hint_cache = get_hint_cache()
+    st.checkbox(
+        label="Reuse hints cached for identical requests",
+        value=True,
+        key=SPYMASTER_CACHE_KEY,
+        help="The cache is always bypassed for temperatures above "
+        f"{hint_cache.creative_temperature}",
     )
+    st.caption(
+        "Hint cache: {hits} hits, {misses} misses, {size} entries".format(
+            **hint_cache.stats
+        )
+    )
+    single_flight = get_single_flight()
+    st.checkbox(
+        label="Share identical requests with other games",
+        value=True,
+        key=SPYMASTER_COALESCE_KEY,
+        help="Games sending the exact same request at the same time, e.g. on "
+        "the same board, wait for a single API call. Never done for temperatures "
+        f"above {single_flight.creative_temperature}, so that every game gets "
+        "its own hint.",
+    )
+    st.caption(f"{single_flight.shared} requests shared")
+    st.checkbox(
+        label="Ask for structured (JSON) hints",
+        value=False,
+        key=SPYMASTER_STRUCTURED_KEY,
+        help="Constrain answers to a JSON hint with a schema, so that they never "
+        "need to be retried because of their format. Requires a backend "
+        "supporting structured output, such as recent OpenAI models.",
+    )
+    for model, counts in PARSE_STATS.as_dict().items():
+        st.caption(
+            f"{model}: {counts['failed']} unparseable answers out of "
+            f"{counts['parsed'] + counts['failed']}"
+        )
 
 with col2:
     st.slider(
@@ -42,6 +169,16 @@ with col2:
         value=st.session_state.get(SPYMASTER_TEMP_KEY, DEFAULT_SPYMASTER_TEMPERATURE),
         key=SPYMASTER_TEMP_KEY,
     )
+    st.number_input(
+        "Candidate hints per request",
+        min_value=1,
+        max_value=8,
+        value=st.session_state.get(SPYMASTER_CANDIDATES_KEY, 1),
+        key=SPYMASTER_CANDIDATES_KEY,
+        help="Sample several hints in a single request and keep the best valid "
+        "one, instead of retrying one request at a time when a hint is invalid. "
+        "Costs more completion tokens, and hints are not streamed above 1.",
+    )
 
 st.text_area(
     label="System Instruction",
@@ -66,6 +203,18 @@ st.text(
 )
 
 
+# Configure the board
+st.subheader("Board")
+st.select_slider(
+    "Board size",
+    options=SIDE_LENGTHS,
+    value=st.session_state.get(BOARD_SIZE_KEY, DEFAULT_SIDE_LENGTH),
+    format_func=lambda x: f"{x}x{x}",
+    key=BOARD_SIZE_KEY,
+    help="Takes effect at the next game. The number of cards of each team, "
+    "neutral cards and assassins scale with the board size.",
+)
+
 # Configure the list of words to build the board
 st.subheader("Word List")
 options = get_lang_options()
@@ -76,7 +225,8 @@ except ValueError:
 
 
 def __update_lang__() -> None:
-    del st.session_state[BOARD_WORDS_KEY]
+    PERSISTENCE.pop(BOARD_WORDS_KEY)
+    st.session_state.pop(BOARD_POOL_KEY, None)
 
 
 lang = st.selectbox(
@@ -89,11 +239,66 @@ lang = st.selectbox(
     on_change=__update_lang__,
 )
 
+
+def __get_pool__() -> WordPool:
+    # An edited list may be empty, which is still the list in use
+    pool = st.session_state.get(BOARD_POOL_KEY)
+    return get_word_pool(lang) if pool is None else pool
+
+
+def __update_pool__() -> None:
+    pool = __get_pool__().updated(st.session_state[BOARD_WORDS_KEY])
+    st.session_state[BOARD_POOL_KEY] = pool
+
+
 st.text_area(
     label="Edit words list",
     value=st.session_state.get(BOARD_WORDS_KEY, get_default_words_list(lang)),
     key=BOARD_WORDS_KEY,
+    on_change=__update_pool__,
 )
+st.caption(f"{len(__get_pool__())} distinct words")
+
+# Server metrics, shared by all sessions
+with st.expander("Diagnostics"):
+    if not METRICS.enabled:
+        st.caption("Metrics are disabled (`CODENAMES_METRICS=0`)")
+    timers = METRICS.timers()
+    if len(timers):
+        st.dataframe(
+            [
+                {
+                    "timer": name,
+                    "labels": ", ".join(f"{k}={v}" for k, v in labels.items()),
+                    "count": stats["count"],
+                    **{
+                        f"{x} ms": round(stats[x] * 1000, 1)
+                        for x in ("mean", "p50", "p95", "max")
+                    },
+                }
+                for name, labels, stats in timers
+            ],
+            hide_index=True,
+        )
+    counters = METRICS.counters()
+    if len(counters):
+        st.dataframe(
+            [
+                {
+                    "counter": name,
+                    "labels": ", ".join(f"{k}={v}" for k, v in labels.items()),
+                    "value": value,
+                }
+                for name, labels, value in counters
+            ],
+            hide_index=True,
+        )
+    st.download_button(
+        "Download metrics (Prometheus format)",
+        data=METRICS.prometheus(),
+        file_name="codenames_metrics.txt",
+        mime="text/plain",
+    )
 
 # Persist session state across pages
-persist_session_state(__PAGE_NAME__)
+PERSISTENCE.save(__PAGE_NAME__)
@@ -1,33 +1,98 @@
-from typing import Optional
+from typing import Any, Dict, Set
 
 import streamlit as st
 
-__PERSISTENT_KEYS__ = set()
+from telemetry import METRICS
 
 
-def persist_key(key: str) -> str:
-    """Mark widget key as persistent"""
-    global __PERSISTENT_KEYS__
-    __PERSISTENT_KEYS__.add(key)
-    return key
+class PersistenceManager:
+    """Carry the values of persistent widgets across pages
+
+    Streamlit drops the state of widgets as soon as a run does not render them,
+    so the values of persistent widgets are saved, per session, in a dict of
+    their own. Keys are namespaced by the page rendering them: a page restores
+    the values of its widgets before rendering them, and saves the values which
+    changed at the end of its run. Other pages read them with `get`.
+    """
+
+    # Session state key of the saved values
+    VALUES_KEY = "_persisted_values"
+
+    def __init__(self) -> None:
+        self.namespaces: Dict[str, Set[str]] = {}
+
+    def key(self, namespace: str, name: str) -> str:
+        """Register and return the key of a persistent widget of a page"""
+        key = f"{namespace}_{name}"
+        self.namespaces.setdefault(namespace, set()).add(key)
+        return key
+
+    @property
+    def values(self) -> Dict[str, Any]:
+        """Saved values of the current session"""
+        return st.session_state.setdefault(self.VALUES_KEY, {})
+
+    def __contains__(self, key: str) -> bool:
+        return key in st.session_state or key in self.values
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Value of a persistent widget, rendered or not"""
+        if key in st.session_state:
+            return st.session_state[key]
+        return self.values.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Set the value of a persistent widget, before it is rendered"""
+        self.values[key] = value
+        st.session_state[key] = value
+
+    def pop(self, key: str) -> None:
+        """Reset a persistent widget to its default value"""
+        self.values.pop(key, None)
+        st.session_state.pop(key, None)
+
+    def restore(self, namespace: str) -> None:
+        """Restore the values of the widgets of a page, to be called before
+        rendering them"""
+        values = self.values
+        for key in self.namespaces.get(namespace, ()):
+            if key not in st.session_state and key in values:
+                st.session_state[key] = values[key]
+
+    def save(self, namespace: str) -> None:
+        """Save the values of the widgets of a page which changed, to be called
+        at the end of every run of the page"""
+        with METRICS.timer("phase_seconds", phase="persist"):
+            values = self.values
+            for key in self.namespaces.get(namespace, ()):
+                if key in st.session_state:
+                    value = st.session_state[key]
+                    if key not in values or values[key] != value:
+                        values[key] = value
+
+
+PERSISTENCE = PersistenceManager()
 
 
 """Define Settings keys that will be used by both the Settings and Game page"""
 SETTINGS_PAGE_NAME = "Settings"
-SPYMASTER_TEMP_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_temperature")
-SPYMASTER_PROMPT_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_spymaster_prompt")
-SPYMASTER_INSTRUCT_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_spymaster_instruct")
-SPYMASTER_BEHAVIOR_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_spymaster_behavior")
-BOARD_WORDS_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_word_list")
-BOARD_LANG_KEY = persist_key(f"{SETTINGS_PAGE_NAME}_word_lang")
-
-
-def persist_session_state(page_name: Optional[str] = None) -> None:
-    """Force storage of all persistent keys from other papges in session state"""
-    for k, v in st.session_state.items():
-        if (
-            k in __PERSISTENT_KEYS__
-            and isinstance(k, str)
-            and (page_name is None or not k.startswith(page_name))
-        ):
-            st.session_state[k] = v
+SPYMASTER_TEMP_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "temperature")
+SPYMASTER_PROMPT_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_prompt")
+SPYMASTER_INSTRUCT_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_instruct")
+SPYMASTER_BEHAVIOR_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_behavior")
+SPYMASTER_HISTORY_BUDGET_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "history_budget")
+SPYMASTER_HISTORY_TURNS_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "history_turns")
+SPYMASTER_CACHE_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_cache")
+SPYMASTER_COALESCE_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_coalesce")
+SPYMASTER_PREFETCH_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_prefetch")
+SPYMASTER_STREAM_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_stream")
+SPYMASTER_CANDIDATES_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_candidates")
+SPYMASTER_STRUCTURED_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "spymaster_structured")
+BOARD_WORDS_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "word_list")
+BOARD_LANG_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "word_lang")
+BOARD_SIZE_KEY = PERSISTENCE.key(SETTINGS_PAGE_NAME, "board_size")
+# `WordPool` of the words list edited in Settings, if any
+BOARD_POOL_KEY = f"{SETTINGS_PAGE_NAME}_word_pool"
+
+"""Token usage of the current game, set by the Game page and shown in Settings"""
+SPYMASTER_USAGE_KEY = "Game_spymaster_usage"
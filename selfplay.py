@@ -0,0 +1,254 @@
+"""Headless self-play: plays seeded games without Streamlit, using a scripted guesser
+
+Example:
+    python selfplay.py --games 1000 --lang en
+    python selfplay.py --games 100 --latency 0.01 --error-rate 0.1
+    python selfplay.py --games 10 --backend openai --api-key sk-... --model gpt-4o
+"""
+
+import argparse
+import random
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from backends import BACKENDS, MockBackend, get_backend
+from board import KILLER
+from engine import (
+    DEFAULT_HISTORY_BUDGET,
+    DEFAULT_HISTORY_TURNS,
+    DEFAULT_SIDE_LENGTH,
+    HISTORY_MODES,
+    Spymaster,
+    generate_board,
+    init_spymaster,
+    load_word_pool,
+)
+from hint_cache import HintCache
+from hint_parser import PARSE_STATS
+
+
+class ScriptedGuesser:
+    """Guesser which knows the board and picks one of its team's words with
+    probability `accuracy`, or any card still on the board otherwise, after
+    thinking for `think_time` seconds"""
+
+    def __init__(
+        self, accuracy: float = 0.7, random_seed: int = 0, think_time: float = 0.0
+    ) -> None:
+        self.accuracy = accuracy
+        self.rng = random.Random(random_seed)
+        self.think_time = think_time
+
+    def think(self) -> None:
+        """Wait before an action, as a human player would"""
+        if self.think_time > 0:
+            time.sleep(self.think_time)
+
+    def guess(self, team: int, team_assignment: List[int], revealed: List[bool]) -> int:
+        """Return the index of the card to pick for the given `team`"""
+        self.think()
+        candidates = [i for i, r in enumerate(revealed) if not r]
+        if self.rng.random() < self.accuracy:
+            correct = [i for i in candidates if team_assignment[i] == team + 1]
+            if len(correct):
+                candidates = correct
+        return self.rng.choice(candidates)
+
+
+@dataclass
+class GameResult:
+    """Outcome of a single headless game"""
+
+    winner: int
+    assassin: bool
+    num_hints: int
+    num_guesses: int
+    num_requests: int
+    hint_latencies: List[float] = field(default_factory=list)
+    hint_numbers: List[int] = field(default_factory=list)
+    # Whether the game ended with a team finding all its cards, rather than
+    # with the assassin or the opponent's last card
+    won: bool = False
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    last_prompt_tokens: int = 0
+    last_cached_tokens: int = 0
+    estimated_requests: int = 0
+    last_estimated: bool = False
+
+
+def play_game(
+    spymaster: Spymaster,
+    words: List[str],
+    team_assignment: List[int],
+    guesser: ScriptedGuesser,
+    max_guesses: int = 500,
+) -> Optional[GameResult]:
+    """Play a full game until one team wins
+
+    :param spymaster: Spymaster initialized with `words` and `team_assignment`
+    :param guesser: Scripted guesser playing for both teams
+    :param max_guesses: Safety limit on the number of guesses; returns None if
+        the game did not end before
+    """
+    revealed = [False] * len(words)
+    hint_latencies, hint_numbers = [], []
+    num_guesses, turn_guesses = 0, 0
+    # Team and card type of the last guess, which tell how the game ended
+    last_guess = None
+    while num_guesses < max_guesses:
+        winner = spymaster.winner
+        if winner is not None:
+            team, card = last_guess
+            return GameResult(
+                winner=winner,
+                assassin=card == KILLER,
+                num_hints=len(hint_latencies),
+                num_guesses=num_guesses,
+                num_requests=spymaster.num_requests,
+                hint_latencies=hint_latencies,
+                hint_numbers=hint_numbers,
+                won=card == team + 1,
+                **spymaster.token_usage,
+            )
+
+        needs_hint = spymaster.current_hint_word is None
+        start = time.perf_counter()
+        spymaster.play()
+        if needs_hint and spymaster.current_hint_word is not None:
+            hint_latencies.append(time.perf_counter() - start)
+            hint_numbers.append(spymaster.og_hint_num)
+            turn_guesses = 0
+
+        # Guess a card; stop after as many guesses as the hint number
+        team = spymaster.current_team
+        idx = guesser.guess(team, team_assignment, revealed)
+        revealed[idx] = True
+        spymaster.remove(words[idx], team_assignment[idx])
+        last_guess = (team, team_assignment[idx])
+        num_guesses += 1
+        turn_guesses += 1
+        if (
+            spymaster.current_team == team
+            and spymaster.current_hint_word is not None
+            and turn_guesses >= spymaster.og_hint_num
+        ):
+            guesser.think()
+            spymaster.end_turn()
+    return None
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of `values` for `q` in [0, 100]"""
+    if not len(values):
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=1000, help="Number of games")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first game")
+    parser.add_argument("--lang", default="en", help="Language of the words list")
+    parser.add_argument("--side-length", type=int, default=DEFAULT_SIDE_LENGTH)
+    parser.add_argument("--accuracy", type=float, default=0.7, help="Guesser accuracy")
+    parser.add_argument("--think-time", type=float, default=0.0, help="In seconds")
+    parser.add_argument("--backend", default=MockBackend.name, choices=list(BACKENDS))
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--base-url", default="", help="OpenAI-compatible endpoint")
+    parser.add_argument("--model", default=None, help="Defaults to the first model")
+    parser.add_argument("--hint-cache", default=None, help="SQLite hint cache path")
+    parser.add_argument("--prefetch", action="store_true", help="Prefetch hints")
+    parser.add_argument("--stream", action="store_true", help="Stream hints")
+    parser.add_argument(
+        "--candidates", type=int, default=1, help="Hints sampled per request"
+    )
+    parser.add_argument("--history", default="whole", choices=list(HISTORY_MODES))
+    parser.add_argument("--history-budget", type=int, default=DEFAULT_HISTORY_BUDGET)
+    parser.add_argument("--history-turns", type=int, default=DEFAULT_HISTORY_TURNS)
+    parser.add_argument("--structured", action="store_true", help="Ask for JSON hints")
+    mock = parser.add_argument_group("mock backend")
+    mock.add_argument("--latency", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--prefill-latency", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--token-latency", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--jitter", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--malformed-rate", type=float, default=0.0)
+    mock.add_argument("--decorated-rate", type=float, default=0.0)
+    mock.add_argument("--chatty-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    pool = load_word_pool(args.lang)
+    if args.backend == MockBackend.name:
+        backend = MockBackend(
+            latency=args.latency,
+            prefill_latency=args.prefill_latency,
+            token_latency=args.token_latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate,
+            decorated_rate=args.decorated_rate,
+            chatty_rate=args.chatty_rate,
+            random_seed=args.seed,
+        )
+    else:
+        backend = get_backend(args.backend, args.api_key, args.base_url)
+    model = args.model or backend.list_models()[0]
+    hint_cache = HintCache(args.hint_cache) if args.hint_cache else None
+
+    results = []
+    start = time.perf_counter()
+    for seed in range(args.seed, args.seed + args.games):
+        words, team_assignment = generate_board(
+            pool, side_length=args.side_length, random_seed=seed
+        )
+        spymaster = init_spymaster(backend, model, words, team_assignment, args.lang)
+        spymaster.use_hint_cache(hint_cache)
+        spymaster.use_history(args.history, args.history_budget, args.history_turns)
+        spymaster.use_prefetch(args.prefetch)
+        spymaster.use_streaming(args.stream)
+        spymaster.use_candidates(args.candidates)
+        spymaster.use_structured_output(args.structured)
+        spymaster.prefetch()
+        guesser = ScriptedGuesser(args.accuracy, seed, args.think_time)
+        result = play_game(spymaster, words, team_assignment, guesser)
+        if result is not None:
+            results.append(result)
+    elapsed = time.perf_counter() - start
+
+    latencies = [x for r in results for x in r.hint_latencies]
+    print(f"Played {len(results)}/{args.games} games in {elapsed:.2f}s")
+    if not len(results):
+        return
+    print(f"  games/s          {len(results) / elapsed:.1f}")
+    print(f"  blue win rate    {statistics.mean(r.winner == 1 for r in results):.3f}")
+    print(f"  assassin rate    {statistics.mean(r.assassin for r in results):.3f}")
+    print(f"  hints/game       {statistics.mean(r.num_hints for r in results):.2f}")
+    print(f"  guesses/game     {statistics.mean(r.num_guesses for r in results):.2f}")
+    num_hints = sum(r.num_hints for r in results)
+    print(f"  requests/hint    {sum(r.num_requests for r in results) / num_hints:.3f}")
+    num_requests = sum(r.num_requests for r in results)
+    print(
+        f"  prompt tok/req   {sum(r.prompt_tokens for r in results) / num_requests:.0f}"
+        f" (last of game {statistics.mean(r.last_prompt_tokens for r in results):.0f})"
+    )
+    prompt_tokens = sum(r.prompt_tokens for r in results)
+    print(
+        f"  cached prompt    "
+        f"{sum(r.cached_tokens for r in results) / max(prompt_tokens, 1):.1%}"
+        f" ({sum(r.estimated_requests for r in results)} requests estimated)"
+    )
+    for q in (50, 95, 99):
+        print(f"  hint latency p{q:<3} {percentile(latencies, q) * 1000:.3f}ms")
+    if hint_cache is not None:
+        print(f"  hint cache       {hint_cache.stats}")
+    for name, counts in PARSE_STATS.as_dict().items():
+        print(f"  parsed answers   {name}: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,41 @@ def set_game_style() -> None:
                 margin-top: 1rem;
             }
 
-            .element-container:has(.card) + div button {
+            div[class*="st-key-card_"] button {
                 height: 55px;
                 width: 130px;
                 margin: 1px
             }
 
+            div[class*="st-key-card_blue_"] button:disabled {
+                &,
+                &:hover {
+                    background-color: DodgerBlue
+                }
+            }
+
+            div[class*="st-key-card_red_"] button:disabled {
+                &,
+                &:hover {
+                    background-color: FireBrick
+                }
+            }
+
+            div[class*="st-key-card_beige_"] button:disabled {
+                &,
+                &:hover {
+                    background-color: BlanchedAlmond;
+                    color: Brown
+                }
+            }
+
+            div[class*="st-key-card_black_"] button:disabled {
+                &,
+                &:hover {
+                    background-color: Black
+                }
+            }
+
             .element-container:has(.blue) + div button {
                 &,
                 &:hover {
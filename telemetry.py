@@ -0,0 +1,215 @@
+"""Lightweight metrics of the server process: counters and timers, exposed in
+the Prometheus text format and on the Settings page
+
+Recording a value takes a lock and a few dict operations; with metrics
+disabled (`CODENAMES_METRICS=0`), it returns right away.
+
+Example:
+    with METRICS.timer("phase_seconds", phase="load_game"):
+        ...
+    METRICS.inc("hint_cache_total", result="hit")
+"""
+
+import bisect
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets of timers, in seconds
+TIMER_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    """Bucketed counts of a timer, and its most recent values for percentiles"""
+
+    __slots__ = ("buckets", "count", "total", "recent")
+
+    def __init__(self, num_recent: int) -> None:
+        self.buckets = [0] * (len(TIMER_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=num_recent)
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(TIMER_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+
+class _Timer:
+    """Context manager observing the time spent in its block"""
+
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Labels) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.metrics._observe(self.name, self.labels, time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoTimer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    """Thread-safe counters and timers, identified by a name and labels
+
+    :param enabled: If False, nothing is recorded
+    :param num_recent: Number of recent values of each timer kept to compute
+        percentiles
+    """
+
+    def __init__(self, enabled: bool = True, num_recent: int = 1000) -> None:
+        self.enabled = enabled
+        self.num_recent = num_recent
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._timers: Dict[str, Dict[Labels, _Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Add `value` to a counter"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Record a duration"""
+        if self.enabled:
+            self._observe(name, tuple(sorted(labels.items())), seconds)
+
+    def _observe(self, name: str, labels: Labels, seconds: float) -> None:
+        with self._lock:
+            timer = self._timers.setdefault(name, {})
+            if labels not in timer:
+                timer[labels] = _Histogram(self.num_recent)
+            timer[labels].observe(seconds)
+
+    def timer(self, name: str, **labels: str):
+        """Context manager timing its block"""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, tuple(sorted(labels.items())))
+
+    def reset(self) -> None:
+        """Forget all values"""
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def counters(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Name, labels and value of every counter"""
+        with self._lock:
+            return [
+                (name, dict(labels), value)
+                for name, counter in sorted(self._counters.items())
+                for labels, value in counter.items()
+            ]
+
+    def timers(self) -> List[Tuple[str, Dict[str, str], Dict[str, float]]]:
+        """Name, labels and statistics of every timer: count, mean, and the
+        median, 95th percentile and maximum of the recent values, in seconds"""
+        with self._lock:
+            timers = [
+                (name, dict(labels), h.count, h.total, sorted(h.recent))
+                for name, timer in sorted(self._timers.items())
+                for labels, h in timer.items()
+            ]
+        return [
+            (
+                name,
+                labels,
+                {
+                    "count": count,
+                    "mean": total / count,
+                    "p50": statistics.median(recent),
+                    "p95": recent[min(len(recent) - 1, int(0.95 * len(recent)))],
+                    "max": recent[-1],
+                },
+            )
+            for name, labels, count, total, recent in timers
+        ]
+
+    def prometheus(self, prefix: str = "codenames_") -> str:
+        """All metrics in the Prometheus text exposition format"""
+
+        def fmt(labels: Labels, extra: str = "") -> str:
+            parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+        with self._lock:
+            for name, counter in sorted(self._counters.items()):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                for labels, value in counter.items():
+                    lines.append(f"{prefix}{name}{fmt(labels)} {value:g}")
+            for name, timer in sorted(self._timers.items()):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for labels, h in timer.items():
+                    cumulative = 0
+                    for bound, count in zip(TIMER_BUCKETS + ("+Inf",), h.buckets):
+                        cumulative += count
+                        le = fmt(labels, f'le="{bound}"')
+                        lines.append(f"{prefix}{name}_bucket{le} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{fmt(labels)} {h.total:g}")
+                    lines.append(f"{prefix}{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics shared by all games of the process
+METRICS = Metrics(enabled=os.environ.get("CODENAMES_METRICS", "1") != "0")
+
+
+def serve_metrics(
+    port: int, metrics: Optional[Metrics] = None
+) -> "ThreadingHTTPServer":
+    """Serve the metrics at `/metrics` on the given port, in a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    metrics = metrics or METRICS
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
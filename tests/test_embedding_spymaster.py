@@ -0,0 +1,30 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embedding_spymaster import EmbeddingSpymaster, WordVectors
+
+
+def test_clue_not_reversible_by_lower_case_is_not_given_twice():
+    words = ["AUTO", "BUS", "ZUG", "KATZE", "HUND", "MAUS", "BLUME", "BAUM", "GIFT"]
+    team_assignment = [1, 1, 1, 2, 2, 2, 0, 0, -1]
+    rng = np.random.default_rng(0)
+    base = rng.normal(size=(len(words), 16))
+    # "straße" then "verkehr" are the closest clues to the first team's words
+    road = base[:3].mean(axis=0)
+    clues = {
+        "straße": road * 10,
+        "verkehr": road * 10 + rng.normal(size=16) * 0.1,
+    }
+    vocab = [w.lower() for w in words] + list(clues)
+    vectors = np.concatenate([base, np.stack(list(clues.values()))])
+    spymaster = EmbeddingSpymaster(WordVectors(vocab, vectors))
+    spymaster.update_temperature(0)
+    spymaster.update_words(words, team_assignment)
+
+    first = spymaster.complete([]).content
+    second = spymaster.complete([]).content
+    assert first.startswith("STRASSE - ")
+    assert second.startswith("VERKEHR - ")
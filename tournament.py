@@ -0,0 +1,229 @@
+"""Tournament: plays the same seeded games with several spymaster configurations
+and compares how well they play
+
+Games run in parallel in a pool of processes, each playing several games at once
+in threads, so that games waiting for API calls do not block the others. The
+guesser is scripted (see `selfplay.ScriptedGuesser`) and guesses as many cards
+as the hint number.
+
+Configurations are read from a JSON list of objects with a "name" and any of
+"prompt", "instruct", "temperature", "history", "history_budget",
+"history_turns", "candidates" and "structured"; see `DEFAULT_CONFIGS`.
+
+Example:
+    python tournament.py --games 500 --processes 4
+    python tournament.py --configs configs.json --games 50 --threads 16 \\
+        --backend openai --api-key sk-... --model gpt-4o-mini
+"""
+
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from backends import BACKENDS, MockBackend, SpymasterBackend, get_backend
+from engine import (
+    DEFAULT_HISTORY_BUDGET,
+    DEFAULT_HISTORY_TURNS,
+    DEFAULT_SIDE_LENGTH,
+    generate_board,
+    init_spymaster,
+    load_word_pool,
+)
+from selfplay import GameResult, ScriptedGuesser, percentile, play_game
+
+DEFAULT_CONFIGS = [
+    {"name": "whole history", "history": "whole"},
+    {"name": "last prompt only", "history": "last"},
+    {"name": "history budget", "history": "budget"},
+    {"name": "cold", "history": "whole", "temperature": 0.2},
+]
+
+# Backends of the current process, by JSON of their settings
+_BACKENDS: Dict[str, SpymasterBackend] = {}
+
+
+def make_backend(settings: Dict[str, Any], seed: int) -> SpymasterBackend:
+    """Backend of a game: a mock backend seeded by the game, so that results do
+    not depend on the order games are played in, or a backend shared by the
+    games of the process"""
+    if settings["backend"] == MockBackend.name:
+        return MockBackend(**settings["mock"], random_seed=seed)
+    key = json.dumps(settings, sort_keys=True)
+    if key not in _BACKENDS:
+        _BACKENDS[key] = get_backend(
+            settings["backend"], settings["api_key"], settings["base_url"]
+        )
+    return _BACKENDS[key]
+
+
+def run_game(
+    config: Dict[str, Any], seed: int, settings: Dict[str, Any]
+) -> Optional[GameResult]:
+    """Play the game of the given seed with a spymaster configuration"""
+    words, team_assignment = generate_board(
+        load_word_pool(settings["lang"]), settings["side_length"], random_seed=seed
+    )
+    spymaster = init_spymaster(
+        make_backend(settings, seed),
+        settings["model"],
+        words,
+        team_assignment,
+        settings["lang"],
+    )
+    if "prompt" in config:
+        spymaster.update_prompt(config["prompt"])
+    if "instruct" in config:
+        spymaster.update_instruct(config["instruct"])
+    if "temperature" in config:
+        spymaster.update_temperature(config["temperature"])
+    spymaster.use_history(
+        config.get("history", "whole"),
+        config.get("history_budget", DEFAULT_HISTORY_BUDGET),
+        config.get("history_turns", DEFAULT_HISTORY_TURNS),
+    )
+    spymaster.use_candidates(config.get("candidates", 1))
+    spymaster.use_structured_output(config.get("structured", False))
+    guesser = ScriptedGuesser(settings["accuracy"], seed)
+    return play_game(spymaster, words, team_assignment, guesser)
+
+
+def run_games(
+    jobs: List[Tuple[int, Dict[str, Any], int]],
+    settings: Dict[str, Any],
+    num_threads: int,
+) -> List[Tuple[int, Optional[GameResult]]]:
+    """Play games `(config index, config, seed)` in a pool of threads, and
+    return their results with their configuration index"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = executor.map(lambda job: run_game(job[1], job[2], settings), jobs)
+        return [(job[0], result) for job, result in zip(jobs, results)]
+
+
+def summarize(results: List[GameResult], num_games: int) -> Dict[str, float]:
+    """Statistics of the games played with a configuration"""
+    latencies = [x for r in results for x in r.hint_latencies]
+    hint_numbers = [x for r in results for x in r.hint_numbers]
+    num_hints = max(sum(r.num_hints for r in results), 1)
+    num_requests = sum(r.num_requests for r in results)
+    tokens = [r.prompt_tokens + r.completion_tokens for r in results]
+    return {
+        "games": len(results),
+        "unfinished": num_games - len(results),
+        "win_rate": statistics.mean(r.won for r in results),
+        "assassin_rate": statistics.mean(r.assassin for r in results),
+        "hints_per_game": statistics.mean(r.num_hints for r in results),
+        "mean_hint_number": statistics.mean(hint_numbers) if hint_numbers else 0.0,
+        "retries_per_hint": (num_requests - num_hints) / num_hints,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "tokens_per_game": statistics.mean(tokens),
+        "total_tokens": sum(tokens),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--configs", default=None, help="JSON configurations file")
+    parser.add_argument("--games", type=int, default=100, help="Games per config")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first game")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--threads", type=int, default=8, help="Games played at once per process"
+    )
+    parser.add_argument("--lang", default="en", help="Language of the words list")
+    parser.add_argument("--side-length", type=int, default=DEFAULT_SIDE_LENGTH)
+    parser.add_argument("--accuracy", type=float, default=0.7, help="Guesser accuracy")
+    parser.add_argument("--backend", default=MockBackend.name, choices=list(BACKENDS))
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--base-url", default="", help="OpenAI-compatible endpoint")
+    parser.add_argument("--model", default=None, help="Defaults to the first model")
+    parser.add_argument("--json", default=None, help="Also write the results there")
+    mock = parser.add_argument_group("mock backend")
+    mock.add_argument("--latency", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--jitter", type=float, default=0.0, help="In seconds")
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--malformed-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    configs = DEFAULT_CONFIGS
+    if args.configs is not None:
+        with open(args.configs) as f:
+            configs = json.load(f)
+    settings = {
+        "lang": args.lang,
+        "side_length": args.side_length,
+        "accuracy": args.accuracy,
+        "backend": args.backend,
+        "api_key": args.api_key,
+        "base_url": args.base_url,
+        "mock": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "malformed_rate": args.malformed_rate,
+        },
+    }
+    settings["model"] = args.model or make_backend(settings, 0).list_models()[0]
+
+    # Every configuration plays the same boards
+    seeds = range(args.seed, args.seed + args.games)
+    jobs = [(i, config, seed) for seed in seeds for i, config in enumerate(configs)]
+    start = time.perf_counter()
+    if args.processes > 1:
+        chunks = [jobs[i :: args.processes] for i in range(args.processes)]
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            outcomes = [
+                x
+                for chunk in executor.map(
+                    run_games,
+                    chunks,
+                    [settings] * len(chunks),
+                    [args.threads] * len(chunks),
+                )
+                for x in chunk
+            ]
+    else:
+        outcomes = run_games(jobs, settings, args.threads)
+    elapsed = time.perf_counter() - start
+
+    summaries = {}
+    for i, config in enumerate(configs):
+        results = [r for j, r in outcomes if j == i and r is not None]
+        if len(results):
+            summaries[config["name"]] = summarize(results, args.games)
+
+    print(
+        f"Played {len(jobs)} games, {args.games} per configuration, "
+        f"in {elapsed:.2f}s on model {settings['model']}"
+    )
+    columns = [
+        ("win", "win_rate", "{:.3f}"),
+        ("assassin", "assassin_rate", "{:.3f}"),
+        ("hint num", "mean_hint_number", "{:.2f}"),
+        ("hints", "hints_per_game", "{:.1f}"),
+        ("retries", "retries_per_hint", "{:.3f}"),
+        ("p50 ms", "latency_p50_ms", "{:.1f}"),
+        ("p95 ms", "latency_p95_ms", "{:.1f}"),
+        ("p99 ms", "latency_p99_ms", "{:.1f}"),
+        ("tok/game", "tokens_per_game", "{:.0f}"),
+    ]
+    width = max(len(name) for name in summaries) if summaries else 0
+    print(" ".join([" " * width] + [f"{header:>9}" for header, _, _ in columns]))
+    for name, summary in summaries.items():
+        print(
+            " ".join(
+                [name.ljust(width)]
+                + [f"{fmt.format(summary[key]):>9}" for _, key, fmt in columns]
+            )
+        )
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
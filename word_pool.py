@@ -0,0 +1,68 @@
+"""Index of the words boards are drawn from"""
+
+import hashlib
+import heapq
+import sys
+from typing import FrozenSet, Iterable, Optional
+
+
+def word_hash(word: str) -> int:
+    """64 bits hash of a word, stable across processes"""
+    return int.from_bytes(
+        hashlib.blake2b(word.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def parse_words(text: str) -> FrozenSet[str]:
+    """Distinct upper case words of a words list with one word per line"""
+    words = set()
+    for line in text.upper().splitlines():
+        word = line.strip()
+        if len(word):
+            words.add(sys.intern(word))
+    return frozenset(words)
+
+
+class WordPool:
+    """Immutable, deduplicated and sorted words list
+
+    The fingerprint identifies the pool content: it is the sum of the hashes of
+    its words, so that it can be updated without rehashing unchanged words.
+
+    :param words: Distinct words, sorted
+    :param fingerprint: Fingerprint of `words`, computed if not given
+    """
+
+    __slots__ = ("words", "word_set", "fingerprint")
+
+    def __init__(self, words: Iterable[str], fingerprint: Optional[int] = None) -> None:
+        self.words = tuple(words)
+        self.word_set = frozenset(self.words)
+        if fingerprint is None:
+            fingerprint = sum(word_hash(w) for w in self.words) % 2**64
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_text(cls, text: str) -> "WordPool":
+        """Build a pool from a words list with one word per line"""
+        return cls(sorted(parse_words(text)))
+
+    def updated(self, text: str) -> "WordPool":
+        """Pool of an edited version of the words list: only the added and
+        removed words are sorted and hashed, and the pool itself is returned if
+        its words did not change"""
+        words = parse_words(text)
+        if words == self.word_set:
+            return self
+        added, removed = words - self.word_set, self.word_set - words
+        kept = (w for w in self.words if w not in removed)
+        fingerprint = self.fingerprint
+        fingerprint += sum(word_hash(w) for w in added)
+        fingerprint -= sum(word_hash(w) for w in removed)
+        return WordPool(heapq.merge(kept, sorted(added)), fingerprint % 2**64)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __repr__(self) -> str:
+        return f"WordPool({len(self.words)} words, {self.fingerprint:016x})"